@@ -0,0 +1,240 @@
+# Load test for the webservices with Snowflake service function payloads
+# Reports latency percentiles, rows per second and tokens per second of every batch size and concurrency as JSON
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+import httpx
+from workload import Workload, build_payload, endpoints, start_image_server
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+image_endpoints = {('open_clip', '/encode_image')}
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+# Token counters of the /metrics endpoint, tokens per second are computed from the difference before and after a run
+async def read_token_counters(client, url):
+    try:
+        response = await client.get(f'{url}/metrics')
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return {}
+    counters = {}
+    for line in response.text.splitlines():
+        match = re.match(r'^(prompt_tokens_total|generated_tokens_total) (\S+)$', line)
+        if match:
+            counters[match.group(1)] = float(match.group(2))
+    return counters
+
+async def wait_until_ready(client, url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Service exited with code {process.returncode} during startup')
+        try:
+            if (await client.get(f'{url}/ready')).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f'Service at {url} was not ready after {timeout} seconds')
+
+# Sends all payloads with a fixed number of concurrent requests
+async def run(client, url, endpoint, payloads, concurrency):
+    latencies = []
+    counts = Counter()
+    errors = Counter()
+    pending = iter(payloads)
+
+    async def worker():
+        for payload in pending:
+            started = time.perf_counter()
+            try:
+                response = await client.post(f'{url}{endpoint}', json=payload)
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] += 1
+                continue
+            if response.status_code != 200:
+                errors[str(response.status_code)] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            rows = response.json()['data']
+            counts['rows'] += len(rows)
+            counts['failed_rows'] += sum(1 for row in rows if row[1] is None)
+
+    before = await read_token_counters(client, url)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+    after = await read_token_counters(client, url)
+
+    tokens = {name: after[name] - before.get(name, 0) for name in after}
+    return {
+        'requests': len(payloads),
+        'successful_requests': len(latencies),
+        'rows': counts['rows'],
+        'failed_rows': counts['failed_rows'],
+        'errors': dict(errors),
+        'duration_seconds': duration,
+        'latency_seconds': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'max': max(latencies, default=None),
+        },
+        'requests_per_second': len(latencies) / duration,
+        'rows_per_second': counts['rows'] / duration,
+        'tokens_per_second': tokens['generated_tokens_total'] / duration if 'generated_tokens_total' in tokens else None,
+        'prompt_tokens_per_second': tokens['prompt_tokens_total'] / duration if 'prompt_tokens_total' in tokens else None,
+    }
+
+# Runs that got slower or lost throughput compared to a previous report
+def find_regressions(report, baseline, tolerance):
+    baseline_runs = {(run['batch_size'], run['concurrency']): run for run in baseline['runs']}
+    regressions = []
+    for run in report['runs']:
+        previous = baseline_runs.get((run['batch_size'], run['concurrency']))
+        if previous is None:
+            continue
+        name = f"batch size {run['batch_size']}, concurrency {run['concurrency']}"
+        p95, previous_p95 = run['latency_seconds']['p95'], previous['latency_seconds']['p95']
+        if p95 is not None and previous_p95 and p95 > previous_p95 * (1 + tolerance):
+            regressions.append(f'{name}: p95 latency {p95:.3f}s, baseline {previous_p95:.3f}s')
+        if run['rows_per_second'] < previous['rows_per_second'] * (1 - tolerance):
+            regressions.append(f"{name}: {run['rows_per_second']:.1f} rows/s, baseline {previous['rows_per_second']:.1f} rows/s")
+    return regressions
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+async def main(args):
+    endpoint = args.endpoint or next(iter(endpoints[args.service]))
+    if endpoint not in endpoints[args.service]:
+        raise SystemExit(f'Unknown endpoint {endpoint} for {args.service}, choose from {list(endpoints[args.service])}')
+    process = None
+    image_server = None
+    url = args.url
+    if args.tiny:
+        port = free_port()
+        process = subprocess.Popen([
+            sys.executable, os.path.join(benchmark_dir, 'serve_tiny.py'), args.service, '--port', str(port), '--models', args.models
+        ])
+        url = f'http://127.0.0.1:{port}'
+
+    image_urls = []
+    if args.image_urls:
+        with open(args.image_urls) as f:
+            image_urls = [line.strip() for line in f if line.strip()]
+    elif (args.service, endpoint) in image_endpoints:
+        # The service has to be able to reach this machine, e.g. with --tiny or a locally running container
+        total_rows = sum(args.batch_sizes) * len(args.concurrency) * args.requests
+        image_server, image_urls = start_image_server(args.distinct_images or total_rows, *args.image_size)
+
+    workload = Workload(
+        prompt_length=args.prompt_length,
+        distinct_prompts=args.distinct_prompts,
+        image_urls=image_urls,
+        distinct_images=args.distinct_images,
+        max_new_tokens=args.max_new_tokens,
+        languages=args.languages.split(','),
+        seed=args.seed
+    )
+    report = {
+        'service': args.service,
+        'endpoint': endpoint,
+        'url': url,
+        'tiny': args.tiny,
+        'prompt_length': args.prompt_length,
+        'seed': args.seed,
+        'runs': [],
+    }
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=max(args.concurrency))) as client:
+            await wait_until_ready(client, url, args.startup_timeout, process)
+            for _ in range(args.warmup_requests):
+                await client.post(f'{url}{endpoint}', json=build_payload(args.service, endpoint, workload, 1))
+            for batch_size in args.batch_sizes:
+                for concurrency in args.concurrency:
+                    # Payloads are built before the run so that building them isn't measured
+                    payloads = [build_payload(args.service, endpoint, workload, batch_size) for _ in range(args.requests)]
+                    result = await run(client, url, endpoint, payloads, concurrency)
+                    report['runs'].append({'batch_size': batch_size, 'concurrency': concurrency, **result})
+                    print(
+                        f"batch size {batch_size}, concurrency {concurrency}: "
+                        f"p50 {result['latency_seconds']['p50'] or 0:.3f}s, p95 {result['latency_seconds']['p95'] or 0:.3f}s, "
+                        f"{result['rows_per_second']:.1f} rows/s, errors {result['errors']}",
+                        file=sys.stderr
+                    )
+            try:
+                report['service_stats'] = (await client.get(f'{url}/stats')).json()
+            except (httpx.HTTPError, ValueError):
+                pass
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if image_server is not None:
+            image_server.shutdown()
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a webservice with Snowflake service function payloads')
+    parser.add_argument('service', choices=list(endpoints))
+    parser.add_argument('--endpoint', help='Endpoint to benchmark, defaults to the first endpoint of the service')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='Base URL of a running service, e.g. http://localhost:9000')
+    target.add_argument('--tiny', action='store_true', help='Start the service on CPU with tiny stand-in models')
+    parser.add_argument('--models', default='/tmp/scs_llm_zoo_tiny_models', help='Directory of the stand-in models for --tiny')
+    parser.add_argument('--batch-sizes', type=int_list, default=[1, 8, 32], help='Comma separated rows per request')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4], help='Comma separated number of concurrent requests')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per batch size and concurrency')
+    parser.add_argument('--warmup-requests', type=int, default=2)
+    parser.add_argument('--prompt-length', default='uniform:8:128', help='Words per prompt: fixed:N, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or choice:A,B,C')
+    parser.add_argument('--distinct-prompts', type=int, default=0, help='Number of different prompts, 0 makes every prompt unique')
+    parser.add_argument('--languages', default='EN,AR', help='Languages of the jais prompts')
+    parser.add_argument('--max-new-tokens', type=int, default=64, help='Generated tokens for endpoints that accept a limit')
+    parser.add_argument('--image-urls', help='File with one image URL per line, a local image server is used if not set')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[640, 480], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--distinct-images', type=int, default=0, help='Number of different images, 0 makes every image unique')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout per request in seconds')
+    parser.add_argument('--startup-timeout', type=float, default=1800, help='Maximum time in seconds to wait for /ready')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='Previous JSON report, exits with code 1 if a run regressed')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression compared to the baseline')
+    args = parser.parse_args()
+    if args.tiny and args.service == 'glm_4v_9b':
+        parser.error('glm_4v_9b has no tiny stand-in model, benchmark a running service with --url')
+
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,54 @@
+# Fixtures that run the webservices on CPU with the tiny stand-in models of tiny_models.py, see serve_tiny.py
+# The stand-in models are built once into TINY_MODELS_DIR and kept for later runs
+import os
+import subprocess
+import sys
+import time
+import httpx
+import pytest
+import tiny_models
+from benchmark import benchmark_dir, free_port
+
+tiny_models_dir = os.getenv('TINY_MODELS_DIR', '/tmp/scs_llm_zoo_tiny_models')
+
+@pytest.fixture(scope='session')
+def models_dir():
+    if not os.path.isdir(os.path.join(tiny_models_dir, 'alibi_lm')):
+        tiny_models.build_all(tiny_models_dir)
+    return tiny_models_dir
+
+# Starts a service with serve_tiny.py and the given environment variables and returns a client once it is ready
+# The services of a test module are stopped after its last test
+@pytest.fixture(scope='module')
+def serve_tiny(models_dir):
+    processes = []
+
+    def start(service, timeout=600, **env):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(benchmark_dir, 'serve_tiny.py'), service, '--port', str(port), '--models', models_dir],
+            env={**os.environ, **env}
+        )
+        processes.append(process)
+        client = httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=300)
+        deadline = time.monotonic() + timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f'{service} exited with code {process.returncode} during startup')
+            try:
+                if client.get('/ready').status_code == 200:
+                    return client
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{service} was not ready after {timeout} seconds')
+            time.sleep(0.5)
+
+    yield start
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
@@ -0,0 +1,33 @@
+# Starts a webservice on CPU with the tiny stand-in models of tiny_models.py
+# The webservice code is used as it is, only the models and cache locations are replaced through its environment variables
+import argparse
+import os
+import sys
+import tiny_models
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+services = ['phi_3_mini_128k_instruct', 'jais_13b', 'open_clip']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a webservice with tiny stand-in models on CPU')
+    parser.add_argument('service', choices=services)
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--models', default='/tmp/scs_llm_zoo_tiny_models', help='Directory of the stand-in models, built if missing')
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.models, 'alibi_lm')):
+        tiny_models.build_all(args.models)
+    os.environ['HUGGINGFACE_MODEL'] = os.path.join(args.models, 'alibi_lm' if args.service == 'jais_13b' else 'causal_lm')
+    os.environ['OPENCLIP_MODEL'] = tiny_models.open_clip_model
+    os.environ['OPENCLIP_CHECKPOINT'] = ''
+    if args.service == 'open_clip':
+        import open_clip
+        open_clip.add_model_config(os.path.join(args.models, 'open_clip'))
+
+    # The shared modules in common are imported from the repository root, also by the replica processes
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_dir, os.getenv('PYTHONPATH')]))
+    sys.path.insert(0, repo_dir)
+    sys.path.insert(0, os.path.join(repo_dir, args.service, 'app'))
+    import uvicorn
+    import webservice
+    uvicorn.run(webservice.app, host='127.0.0.1', port=args.port, log_level='warning')
@@ -0,0 +1,53 @@
+# Micro-batches of the jais service with the cached instruction prefix give the same logits as every row alone
+# The webservice is imported into the test process with the ALiBi stand-in model, see tiny_models.build_alibi_lm
+import importlib.util
+import os
+import sys
+import pytest
+import torch
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+questions = ['What is the capital of France', 'How do birds fly in the desert', 'Name a fruit', 'Why not', 'Name a animal', 'Why', 'How', 'How do plants grow in the desert']
+
+@pytest.fixture(scope='module')
+def jais(models_dir):
+    os.environ['HUGGINGFACE_MODEL'] = os.path.join(models_dir, 'alibi_lm')
+    sys.path.insert(0, repo_dir)
+    spec = importlib.util.spec_from_file_location('jais_webservice', os.path.join(repo_dir, 'jais_13b', 'app', 'webservice.py'))
+    webservice = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(webservice)
+    webservice.load_model()
+    return webservice
+
+# Logits of the next token of every row, computed the same way as generate() continues from prepare_batch
+def next_token_logits(jais, rows, prefix):
+    input_ids, attention_mask, past_key_values = jais.prepare_batch(rows, prefix)
+    with torch.no_grad():
+        if past_key_values is None:
+            return jais.model(input_ids=input_ids, attention_mask=attention_mask).logits[:, -1]
+        return jais.model(input_ids=input_ids[:, -1:], attention_mask=attention_mask, past_key_values=past_key_values).logits[:, -1]
+
+@pytest.mark.parametrize('language', ['EN', 'AR'])
+@pytest.mark.parametrize('use_prefix', [True, False])
+def test_batched_logits_match_unbatched_logits(jais, language, use_prefix):
+    prefix = jais.prefix_cache[language] if use_prefix else None
+    encoded = [jais.tokenizer(jais.prompts[language].format_map({'Question': question})).input_ids for question in questions]
+    micro_batches = jais.plan_micro_batches([len(ids) for ids in encoded], [16] * len(encoded), use_prefix)
+    assert any(len(micro_batch) > 1 for micro_batch in micro_batches)
+    for micro_batch in micro_batches:
+        batched = next_token_logits(jais, [encoded[position] for position in micro_batch], prefix)
+        for position, logits in zip(micro_batch, batched):
+            unbatched = next_token_logits(jais, [encoded[position]], None)[0]
+            torch.testing.assert_close(logits, unbatched, atol=1e-4, rtol=1e-4)
+
+def test_rows_of_different_length_do_not_share_the_prefix(jais):
+    encoded = [jais.tokenizer(jais.prompts['EN'].format_map({'Question': question})).input_ids for question in ('Why', 'What is the capital of France')]
+    with pytest.raises(ValueError):
+        jais.prepare_batch(encoded, jais.prefix_cache['EN'])
+
+# A failing micro-batch only fails its own rows
+def test_failed_micro_batch_only_fails_its_rows(jais):
+    rows = [(jais.prompts['EN'].format_map({'Question': question}), limit) for question, limit in (('Why', 2.5), ('What is the capital of France', 4))]
+    responses = jais.get_responses(rows)
+    assert isinstance(responses[0], Exception)
+    assert isinstance(responses[1], str)
@@ -0,0 +1,33 @@
+# Service function batches that are split across replicas in worker processes, see common/replicas.py
+import pytest
+from benchmark import free_port
+
+rows = [[index, f'hello {index} ' * (index % 5 + 1)] for index in range(12)]
+
+@pytest.fixture(scope='module')
+def services(serve_tiny):
+    env = {'BATCH_SIZE': '2', 'RESPONSE_CACHE': 'false', 'WARMUP_ROWS': '0'}
+    single = serve_tiny('phi_3_mini_128k_instruct', **env)
+    replicated = serve_tiny('phi_3_mini_128k_instruct', REPLICAS='2', REPLICA_BASE_PORT=str(free_port()), **env)
+    return single, replicated
+
+def test_merged_rows_keep_input_order(services):
+    single, replicated = services
+    expected = single.post('/complete', json={'data': rows}).json()['data']
+    response = replicated.post('/complete', json={'data': rows})
+    assert response.status_code == 200
+    assert response.json()['data'] == expected
+    assert [row[0] for row in expected] == [row[0] for row in rows]
+    # Both replicas answered a part of the batch
+    replica_stats = replicated.get('/stats').json()['replicas']
+    assert all(stats['rows'] > 0 for stats in replica_stats.values())
+
+def test_replica_errors_are_passed_on(services):
+    _, replicated = services
+    before = sum(stats['errors'] for stats in replicated.get('/stats').json()['replicas'].values())
+    # Rows without the max_new_tokens and temperature fields fail in the replicas
+    response = replicated.post('/complete_custom', json={'data': [[0, 'You are a helpful assistant.', 'hello']]})
+    assert response.status_code == 500
+    assert response.json()['detail'] == 'Internal Server Error'
+    after = sum(stats['errors'] for stats in replicated.get('/stats').json()['replicas'].values())
+    assert after == before + 1
@@ -0,0 +1,144 @@
+# Responses of the webservices with the tiny stand-in models for service function payloads of the benchmark workload
+import base64
+import concurrent.futures
+import os
+import re
+import numpy as np
+import pytest
+from workload import Workload, build_payload, endpoints, start_image_server
+
+# Row indices that are neither sorted nor contiguous, the responses have to return them in the order of the request
+indices = [7, 2, 40, 0, 13, 5]
+
+def generated_tokens(client):
+    match = re.search(r'^generated_tokens_total (\S+)$', client.get('/metrics').text, re.MULTILINE)
+    return float(match.group(1))
+
+@pytest.fixture(scope='module')
+def image_urls():
+    server, urls = start_image_server(len(indices), 64, 48)
+    yield urls
+    server.shutdown()
+
+@pytest.fixture(scope='module')
+def phi(serve_tiny):
+    return serve_tiny('phi_3_mini_128k_instruct', WARMUP_ROWS='0')
+
+@pytest.fixture(scope='module')
+def jais(serve_tiny):
+    return serve_tiny('jais_13b', WARMUP_ROWS='0', STOP_SEQUENCES='')
+
+@pytest.fixture(scope='module')
+def open_clip(serve_tiny):
+    return serve_tiny('open_clip', DEVICE='cpu', PRECISION='fp32')
+
+@pytest.mark.parametrize('service, endpoint', [(service, endpoint) for service in ('phi_3_mini_128k_instruct', 'jais_13b', 'open_clip') for endpoint in endpoints[service]])
+def test_rows_keep_their_index_and_order(request, image_urls, service, endpoint):
+    client = request.getfixturevalue({'phi_3_mini_128k_instruct': 'phi', 'jais_13b': 'jais', 'open_clip': 'open_clip'}[service])
+    workload = Workload(prompt_length='uniform:2:12', image_urls=image_urls, max_new_tokens=8, seed=1)
+    payload = build_payload(service, endpoint, workload, len(indices))
+    for row, index in zip(payload['data'], indices):
+        row[0] = index
+    response = client.post(endpoint, json=payload)
+    assert response.status_code == 200
+    data = response.json()['data']
+    assert [row[0] for row in data] == indices
+    assert all(len(row) == 2 and row[1] is not None for row in data)
+
+def test_failed_images_are_returned_as_null_rows(open_clip, image_urls):
+    missing = image_urls[0].rsplit('/', 2)[0] + '/missing.jpg'
+    response = open_clip.post('/encode_image', json={'data': [[0, image_urls[0]], [1, missing], [2, image_urls[1]]]})
+    assert response.status_code == 200
+    data = response.json()['data']
+    assert [row[0] for row in data] == [0, 1, 2]
+    assert data[1][1] is None
+    assert data[0][1] is not None and data[2][1] is not None
+
+def test_duplicate_rows_are_generated_once(phi):
+    before = phi.get('/stats').json()['response_cache']
+    rows = [[0, 'first duplicate prompt'], [1, 'another prompt'], [2, 'first duplicate prompt']]
+    data = phi.post('/complete', json={'data': rows}).json()['data']
+    assert data[0][1] == data[2][1]
+    after = phi.get('/stats').json()['response_cache']
+    assert after['deduplicated'] == before.get('deduplicated', 0) + 1
+    assert after['misses'] == before.get('misses', 0) + 2
+    # The same rows are answered from the cache by the next request
+    assert phi.post('/complete', json={'data': rows}).json()['data'] == data
+    assert phi.get('/stats').json()['response_cache']['memory_hits'] == before.get('memory_hits', 0) + 2
+
+# Assisted generation with the stand-in model as its own draft model gives the same greedy responses
+# Rows are sent one per request, only micro-batches of a single row use the draft model
+def test_assisted_generation_matches_greedy_generation(phi, serve_tiny, models_dir):
+    assisted = serve_tiny('phi_3_mini_128k_instruct', WARMUP_ROWS='0', RESPONSE_CACHE='false', DRAFT_MODEL=os.path.join(models_dir, 'causal_lm'))
+    rows = [[0, 'You are terse', 'Name a color', 16, 0.0], [0, 'You are a poet', 'Write about the sea', 24, 0.0], [0, 'sys', 'hello', 8, 0.0]]
+    for row in rows:
+        assert assisted.post('/complete_custom', json={'data': [row]}).json() == phi.post('/complete_custom', json={'data': [row]}).json()
+    stats = assisted.get('/stats').json()['assisted_generation']
+    assert stats['rows'] == len(rows)
+    assert stats['generated_tokens'] > 0
+    assert 0 < stats['acceptance_rate'] <= 1
+    assert stats['tokens_per_second'] > 0
+    assert re.search(r'^assisted_acceptance_rate_count 3\.0$', assisted.get('/metrics').text, re.MULTILINE)
+
+# Greedy rows ignore their temperature, the response is read from the persistent tier because the memory tier holds nothing
+def test_greedy_rows_share_the_disk_cache_across_temperatures(serve_tiny, tmp_path):
+    cached = serve_tiny('phi_3_mini_128k_instruct', WARMUP_ROWS='0', RESPONSE_CACHE_MB='0', RESPONSE_CACHE_DIR=str(tmp_path))
+    responses = [cached.post('/complete_custom', json={'data': [[0, 'You are terse', 'Name a color', 8, temperature]]}).json()['data'] for temperature in (0.0, 0.7)]
+    assert responses[0] == responses[1]
+    stats = cached.get('/stats').json()['response_cache']
+    assert stats['misses'] == 1
+    assert stats['disk_hits'] == 1
+    assert stats['disk_entries'] == 1
+    assert len(list(tmp_path.rglob('*.txt'))) == 1
+
+# The jais service samples, the stand-in model can end a row early with its end of text token
+def test_rows_generate_up_to_their_own_max_new_tokens(jais):
+    for limit in (1, 5, 12):
+        before = generated_tokens(jais)
+        response = jais.post('/complete_custom', json={'data': [[0, 'What is the capital of France', 'EN', limit]]})
+        assert response.status_code == 200
+        assert 0 < generated_tokens(jais) - before <= limit
+
+def test_rows_of_one_batch_keep_their_own_max_new_tokens(jais):
+    limits = [2, 6, 16]
+    before = generated_tokens(jais)
+    rows = [[index, 'What is the capital of France', 'EN', limit] for index, limit in enumerate(limits)]
+    assert jais.post('/complete_custom', json={'data': rows}).status_code == 200
+    assert 0 < generated_tokens(jais) - before <= sum(limits)
+
+# Bad rows are rejected before they are queued, the rows of other requests in the same batch are generated
+@pytest.mark.parametrize('bad_row', [[1, 'Hello', 'EN', 2.5], [1, 'Hello', 'FR', 4], [1, 'Hello', 'EN'], [1, None, 'EN', 4]])
+def test_bad_rows_only_fail_their_request(jais, bad_row):
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        good = executor.submit(jais.post, '/complete_custom', json={'data': [[0, 'What is the capital of France', 'EN', 4]]})
+        bad = executor.submit(jais.post, '/complete_custom', json={'data': [[0, 'What is the capital of France', 'EN', 4], bad_row]})
+        assert bad.result().status_code == 400
+        assert good.result().status_code == 200
+    assert jais.post('/complete_custom', json={'data': [[0, 'Hello', 'EN', 3.0]]}).status_code == 200
+
+# Nearly every response of the stand-in model contains a space, the rows stop at the first one
+def test_stop_sequences_end_generation(serve_tiny):
+    stopped = serve_tiny('jais_13b', WARMUP_ROWS='0', STOP_SEQUENCES=' ')
+    rows = [[index, 'What is the capital of France', 'EN', 32] for index in range(4)]
+    before = generated_tokens(stopped)
+    data = stopped.post('/complete_custom', json={'data': rows}).json()['data']
+    assert all(' ' not in response for _, response in data)
+    early_stop = stopped.get('/stats').json()['early_stop']
+    assert early_stop['stopped_rows'] > 0
+    assert early_stop['saved_tokens'] > 0
+    assert generated_tokens(stopped) - before < 32 * len(rows)
+
+def test_base64_embeddings_match_the_json_embeddings(open_clip):
+    rows = [[0, 'a photo of a cat'], [1, 'a photo of a dog']]
+    embeddings = np.array([row[1] for row in open_clip.post('/encode_text', json={'data': rows}).json()['data']], dtype=np.float32)
+    for output_format, dtype, tolerance in (('base64_float32', '<f4', 1e-6), ('base64_float16', '<f2', 1e-3)):
+        response = open_clip.post('/encode_text', json={'data': rows}, headers={'X-Embedding-Format': output_format})
+        assert response.status_code == 200
+        data = response.json()['data']
+        assert [row[0] for row in data] == [0, 1]
+        decoded = np.array([np.frombuffer(base64.b64decode(row[1]), dtype=dtype) for row in data], dtype=np.float32)
+        np.testing.assert_allclose(decoded, embeddings, atol=tolerance)
+
+def test_unknown_embedding_format_is_rejected(open_clip):
+    response = open_clip.post('/encode_text', json={'data': [[0, 'a photo of a cat']]}, headers={'X-Embedding-Format': 'base64_int8'})
+    assert response.status_code == 400
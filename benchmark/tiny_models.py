@@ -0,0 +1,93 @@
+# Builds tiny stand-in models so that the webservices can be benchmarked on CPU without downloading the real models
+# The stand-ins have the same interfaces as the real models, their outputs are meaningless
+import argparse
+import ast
+import json
+import os
+import torch
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, GPT2Config, GPT2LMHeadModel, MptConfig, MptForCausalLM
+from workload import english_words, arabic_words
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same role markers as the Phi-3 chat template
+chat_template = (
+    "{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}<|end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+# Name of the tiny open_clip model config
+open_clip_model = 'tiny-clip'
+open_clip_config = {
+    "embed_dim": 64,
+    "vision_cfg": {"image_size": 224, "layers": 2, "width": 64, "patch_size": 32, "head_width": 32},
+    "text_cfg": {"context_length": 77, "vocab_size": 49408, "width": 64, "heads": 2, "layers": 2}
+}
+
+# The prompt templates of the jais service, so that the tokenizer is trained on text with realistic token counts
+def jais_prompt_templates():
+    with open(os.path.join(repo_dir, 'jais_13b', 'app', 'webservice.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    templates = []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            if any(isinstance(target, ast.Name) and target.id.startswith('prompt_') for target in node.targets):
+                templates.append(node.value.value)
+    return templates
+
+def build_tokenizer(corpus, vocab_size=4000):
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>", "<|system|>", "<|user|>", "<|assistant|>", "<|end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>")
+    tokenizer.chat_template = chat_template
+    return tokenizer
+
+# Tiny GPT-2 with a context that is long enough for the jais prompts
+def build_causal_lm(path, corpus):
+    tokenizer = build_tokenizer(corpus)
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer), n_positions=4096, n_embd=64, n_layer=2, n_head=2,
+        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.bos_token_id
+    )
+    GPT2LMHeadModel(config).save_pretrained(path, safe_serialization=True)
+
+# Tiny MPT for the jais service, like Jais it has no position embeddings and biases the attention with ALiBi
+# by token index, so left padding in the middle of a prompt changes its output. Uses the tokenizer of the GPT-2
+def build_alibi_lm(path, tokenizer_path):
+    tokenizer = PreTrainedTokenizerFast.from_pretrained(tokenizer_path)
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = MptConfig(
+        vocab_size=len(tokenizer), max_seq_len=4096, d_model=64, n_layers=2, n_heads=2, use_cache=True,
+        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.bos_token_id
+    )
+    MptForCausalLM(config).save_pretrained(path, safe_serialization=True)
+
+def build_open_clip_config(path):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f'{open_clip_model}.json'), 'w') as f:
+        json.dump(open_clip_config, f)
+
+def build_all(output_dir):
+    words = english_words + arabic_words
+    corpus = jais_prompt_templates() + [' '.join(words[start:start + 50]) for start in range(0, len(words), 50)]
+    build_causal_lm(os.path.join(output_dir, 'causal_lm'), corpus * 10)
+    build_alibi_lm(os.path.join(output_dir, 'alibi_lm'), os.path.join(output_dir, 'causal_lm'))
+    build_open_clip_config(os.path.join(output_dir, 'open_clip'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build tiny stand-in models for CPU benchmarks')
+    parser.add_argument('--output', default='/tmp/scs_llm_zoo_tiny_models', help='Directory for the stand-in models')
+    args = parser.parse_args()
+    build_all(args.output)
+    print(f'Stand-in models written to {args.output}')
@@ -0,0 +1,147 @@
+# Service function payloads for the benchmark
+# Every endpoint gets rows in the exact shape Snowflake sends them: {"data": [[index, ...], ...]}
+import functools
+import http.server
+import math
+import random
+import threading
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+english_words = (
+    "the a of and to in is you that it he was for on are as with his they at be this have from or one had by word "
+    "but not what all were we when your can said there use an each which she do how their if will up other about out "
+    "many then them these so some her would make like him into time has look two more write go see number no way could "
+    "people my than first water been call who oil its now find long down day did get come made may part data table "
+    "query warehouse snowflake model summary customer order product review price delivery quality support account "
+    "please explain describe translate summarize compare list reasons why because however therefore example question"
+).split()
+
+arabic_words = (
+    "في من على إلى عن مع هذا هذه التي الذي كان يكون ما لا نعم كيف لماذا متى أين هل أنت أنا نحن هم "
+    "كتاب بيت مدينة سيارة طعام ماء شمس قمر يوم ليلة عمل شركة منتج سعر جودة خدمة عميل طلب سؤال جواب اشرح صف ترجم لخص"
+).split()
+
+# Number of words per prompt, e.g. fixed:32, uniform:8:256, lognormal:64:0.8 (median and sigma) or choice:16,64,256
+def length_sampler(spec):
+    kind, *params = spec.split(':')
+    if kind == 'fixed':
+        return lambda rng: int(params[0])
+    if kind == 'uniform':
+        return lambda rng: rng.randint(int(params[0]), int(params[1]))
+    if kind == 'lognormal':
+        median, sigma = float(params[0]), float(params[1])
+        return lambda rng: max(1, round(rng.lognormvariate(math.log(median), sigma)))
+    if kind == 'choice':
+        lengths = [int(length) for length in params[0].split(',')]
+        return lambda rng: rng.choice(lengths)
+    raise ValueError(f'Unknown prompt length distribution: {spec}')
+
+# Random prompts and image URLs of a benchmark run, reproducible for the same seed
+# distinct_prompts and distinct_images limit the number of different values, e.g. to measure cache hits, 0 means every row is unique
+class Workload:
+    def __init__(self, prompt_length='uniform:8:128', distinct_prompts=0, image_urls=None, distinct_images=0,
+                 max_new_tokens=64, languages=('EN', 'AR'), seed=0):
+        self.rng = random.Random(seed)
+        self.prompt_length = length_sampler(prompt_length)
+        self.distinct_prompts = distinct_prompts
+        self.image_urls = image_urls or []
+        self.distinct_images = distinct_images
+        self.max_new_tokens = max_new_tokens
+        self.languages = languages
+        self.seed = seed
+        self.images = 0
+
+    def prompt(self, language='EN'):
+        words = arabic_words if language == 'AR' else english_words
+        if self.distinct_prompts:
+            rng = random.Random(f'{self.seed}-{language}-{self.rng.randrange(self.distinct_prompts)}')
+        else:
+            rng = self.rng
+        return ' '.join(rng.choice(words) for _ in range(self.prompt_length(rng)))
+
+    def language(self):
+        return self.rng.choice(self.languages)
+
+    def image_url(self):
+        if self.distinct_images:
+            number = self.rng.randrange(self.distinct_images)
+        else:
+            number = self.images
+            self.images += 1
+        return self.image_urls[number % len(self.image_urls)]
+
+def phi_complete(index, workload):
+    return [index, workload.prompt()]
+
+def phi_complete_custom(index, workload):
+    return [index, 'You are a helpful digital assistant.', workload.prompt(), workload.max_new_tokens, 0.0]
+
+def jais_complete(index, workload):
+    language = workload.language()
+    return [index, workload.prompt(language), language]
+
+def jais_complete_custom(index, workload):
+    language = workload.language()
+    return [index, workload.prompt(language), language, workload.max_new_tokens]
+
+def open_clip_encode_image(index, workload):
+    return [index, workload.image_url()]
+
+def open_clip_encode_text(index, workload):
+    return [index, workload.prompt()]
+
+def glm_complete(index, workload):
+    args = {'generation_args': {'max_new_tokens': workload.max_new_tokens}}
+    if workload.image_urls:
+        args['file_url'] = workload.image_url()
+    return [index, {'prompt': workload.prompt(), 'args': args}]
+
+# Row builders per service and endpoint
+endpoints = {
+    'phi_3_mini_128k_instruct': {'/complete': phi_complete, '/complete_custom': phi_complete_custom},
+    'jais_13b': {'/complete': jais_complete, '/complete_custom': jais_complete_custom},
+    'open_clip': {'/encode_image': open_clip_encode_image, '/encode_text': open_clip_encode_text},
+    'glm_4v_9b': {'/complete': glm_complete},
+}
+
+def build_payload(service, endpoint, workload, batch_size):
+    build_row = endpoints[service][endpoint]
+    return {"data": [build_row(index, workload) for index in range(batch_size)]}
+
+# Local HTTP server with generated JPEG images for the image endpoints
+# /<width>x<height>/<number>.jpg always returns the same image for the same path
+@functools.lru_cache(maxsize=1024)
+def generate_image(width, height, number):
+    rng = np.random.default_rng(number)
+    # Smooth random colors compress like photos, pure noise would be unrealistically large
+    image = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)).resize((width, height), Image.BICUBIC)
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            size, name = self.path.strip('/').split('/')
+            width, height = (int(value) for value in size.split('x'))
+            body = generate_image(width, height, int(name.split('.')[0]))
+        except ValueError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Starts the image server in a background thread and returns the URLs of count images
+def start_image_server(count, width=640, height=480, host='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((host, 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://{host}:{server.server_address[1]}'
+    return server, [f'{base_url}/{width}x{height}/{number}.jpg' for number in range(count)]
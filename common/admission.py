@@ -0,0 +1,200 @@
+# Admission control of the service function endpoints
+# Every service function request gets a ticket with its deadline. The ticket is dropped when the deadline passes or the
+# caller disconnects, the work of the request checks its ticket and stops as soon as it is dropped
+import time
+import math
+import asyncio
+import contextvars
+from collections import Counter
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter as MetricCounter
+
+rejected_requests = MetricCounter('rejected_requests', 'Service function requests rejected because the admission queue was full or dropped because their deadline passed or their caller disconnected', ['endpoint', 'reason'])
+
+class RequestDropped(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class RequestTicket:
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout if timeout > 0 else None
+        self.dropped_reason = None
+        self.dropped = asyncio.Event()
+
+    # Reason why the request was dropped, None while it is still wanted, safe to call from inference threads
+    def reason(self):
+        if self.dropped_reason is None and self.deadline is not None and time.monotonic() > self.deadline:
+            self.dropped_reason = 'deadline'
+        return self.dropped_reason
+
+    def drop(self, reason):
+        if self.dropped_reason is None:
+            self.dropped_reason = reason
+        self.dropped.set()
+
+    def check(self):
+        reason = self.reason()
+        if reason is not None:
+            raise RequestDropped(reason)
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None
+
+    # Awaits a coroutine unless the deadline passes or the ticket is dropped first
+    async def wait_for(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        dropped = asyncio.ensure_future(self.dropped.wait())
+        try:
+            await asyncio.wait((task, dropped), timeout=self.remaining(), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            dropped.cancel()
+            pending = not task.done()
+            if pending:
+                task.cancel()
+        if pending:
+            raise RequestDropped(self.reason() or 'deadline')
+        return task.result()
+
+# Ticket of the request that is currently handled, copied into the inference threads with the context of the request
+current_ticket = contextvars.ContextVar('current_ticket', default=None)
+
+def check_ticket():
+    ticket = current_ticket.get()
+    if ticket is not None:
+        ticket.check()
+
+# Awaits the work of the current request unless the request is dropped first
+async def wait_for_request(awaitable):
+    ticket = current_ticket.get()
+    return await (ticket.wait_for(awaitable) if ticket is not None else awaitable)
+
+# Bounded admission queue of one endpoint: up to max_concurrent requests run, up to max_queued requests wait for a slot
+# Retry-After estimates when a slot becomes free from the mean latency of the admitted requests
+class EndpointLimiter:
+    def __init__(self, max_concurrent, max_queued):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.queued = 0
+        self.mean_latency = None
+        self.counters = Counter(admitted=0, queue_full=0, deadline=0, disconnected=0)
+
+    def full(self):
+        return self.active + self.queued >= self.max_concurrent + self.max_queued
+
+    def retry_after(self):
+        return max(1, math.ceil((self.mean_latency or 1.0) * (self.queued + 1) / self.max_concurrent))
+
+    async def acquire(self, ticket):
+        self.queued += 1
+        try:
+            await ticket.wait_for(self.slots.acquire())
+        finally:
+            self.queued -= 1
+        self.active += 1
+        self.counters['admitted'] += 1
+
+    # Only requests that ran to completion update the mean latency
+    def release(self, latency=None):
+        self.active -= 1
+        self.slots.release()
+        if latency is not None:
+            self.mean_latency = latency if self.mean_latency is None else 0.8 * self.mean_latency + 0.2 * latency
+
+    def stats(self):
+        return {
+            'max_concurrent': self.max_concurrent,
+            'max_queued': self.max_queued,
+            'active': self.active,
+            'queued': self.queued,
+            'mean_latency_seconds': self.mean_latency or 0.0,
+            **self.counters,
+        }
+
+# Limits of single endpoints from ENDPOINT_LIMITS as concurrent:queued requests, e.g. /complete=2:8
+def parse_endpoint_limits(value, default_queued):
+    limits = {}
+    for entry in value.split(','):
+        if entry.strip():
+            path, _, limit = entry.strip().partition('=')
+            concurrent, _, queued = limit.partition(':')
+            limits[path] = (int(concurrent), int(queued) if queued else default_queued)
+    return limits
+
+# Seconds until the deadline of a request, REQUEST_TIMEOUT or the shorter X-Request-Timeout header of the client
+def request_time_limit(request, request_timeout):
+    try:
+        requested = float(request.headers.get('x-request-timeout', '0'))
+    except ValueError:
+        requested = 0.0
+    if requested > 0 and (request_timeout <= 0 or requested < request_timeout):
+        return requested
+    return request_timeout
+
+async def watch_disconnect(request, ticket):
+    while not await request.is_disconnected():
+        await asyncio.sleep(0.5)
+    ticket.drop('disconnected')
+
+# Admission queues of the service function endpoints of a webservice, endpoints without limits from ENDPOINT_LIMITS
+# use the default limits. Requests are rejected with 429 while the queue of their endpoint is full and dropped when
+# their deadline passes or their caller disconnects, while they wait or run
+class AdmissionControl:
+    def __init__(self, paths, max_concurrent, max_queued, endpoint_limits, request_timeout):
+        limits = parse_endpoint_limits(endpoint_limits, max_queued)
+        self.limiters = {path: EndpointLimiter(*limits.get(path, (max_concurrent, max_queued))) for path in paths}
+        self.request_timeout = request_timeout
+
+    def rejected_response(self, endpoint, reason):
+        rejected_requests.labels(endpoint, reason).inc()
+        limiter = self.limiters[endpoint]
+        limiter.counters[reason] += 1
+        if reason == 'queue_full':
+            retry_after = limiter.retry_after()
+            return JSONResponse({"detail": f"Too many requests, retry in {retry_after}s"}, status_code=429, headers={'Retry-After': str(retry_after)})
+        if reason == 'deadline':
+            return JSONResponse({"detail": "Request deadline exceeded"}, status_code=504)
+        # Nobody reads the response of a disconnected caller, 499 only shows up in the logs
+        return JSONResponse({"detail": "Client disconnected"}, status_code=499)
+
+    # Adds the middleware and the handler of dropped requests to the app. Must be called after all other middlewares
+    # were added, only the outermost middleware receives the disconnect of the caller directly from the server
+    # Requests are admitted once is_ready() returns True, bypass(request) lets single requests skip admission control
+    def install(self, app, is_ready, bypass=None):
+        async def request_dropped(request: Request, e: RequestDropped):
+            return self.rejected_response(request.url.path, e.reason)
+
+        async def admission_control(request: Request, call_next):
+            endpoint = request.url.path
+            limiter = self.limiters.get(endpoint)
+            if limiter is None or not is_ready() or (bypass is not None and bypass(request)):
+                return await call_next(request)
+            if limiter.full():
+                return self.rejected_response(endpoint, 'queue_full')
+            ticket = RequestTicket(request_time_limit(request, self.request_timeout))
+            # The body is read before the caller is watched, the handler reads it from the cache of the request
+            await request.body()
+            watcher = asyncio.create_task(watch_disconnect(request, ticket))
+            try:
+                try:
+                    await limiter.acquire(ticket)
+                except RequestDropped as e:
+                    return self.rejected_response(endpoint, e.reason)
+                started = time.perf_counter()
+                token = current_ticket.set(ticket)
+                try:
+                    return await call_next(request)
+                finally:
+                    current_ticket.reset(token)
+                    limiter.release(time.perf_counter() - started if ticket.reason() is None else None)
+            finally:
+                watcher.cancel()
+
+        app.add_exception_handler(RequestDropped, request_dropped)
+        app.middleware("http")(admission_control)
+
+    def stats(self):
+        return {path.strip('/'): limiter.stats() for path, limiter in self.limiters.items()}
@@ -0,0 +1,121 @@
+# Persistent tier of the caches of the webservices, files in a directory that are bounded by their total size
+# Files of earlier runs count against the size limit, the least recently used files are evicted first
+# Files that are pinned by a reader are not evicted until they are released
+import os
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger('snowpark-container-service')
+
+class DiskCache:
+    def __init__(self, name, directory, max_bytes, suffix):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.files = OrderedDict()
+        self.bytes = 0
+        self.pins = Counter()
+        self.lock = threading.Lock()
+        self.load_index()
+
+    # Index the files of earlier runs by their modification time
+    def load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(self.suffix):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_mtime, name[:-len(self.suffix)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.files[key] = size
+            self.bytes += size
+        # The size limit may have been lowered since the earlier run
+        self.remove(self.evict())
+        logger.info(f'{self.name}: {len(self.files)} files ({self.bytes / 2**20:.1f} MB) in {self.directory}')
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}{self.suffix}')
+
+    # Returns the content of a cached file or None
+    def read(self, key):
+        with self.lock:
+            if key not in self.files:
+                return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.bytes -= self.files.pop(key, 0)
+            return None
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+        return data
+
+    # Pins a cached file, returns False if it's not cached
+    def pin(self, key):
+        with self.lock:
+            if key not in self.files:
+                return False
+            self.files.move_to_end(key)
+            self.pins[key] += 1
+            return True
+
+    # Files that were skipped by eviction while they were pinned are evicted once they are released
+    def release(self, key):
+        with self.lock:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+            evicted = self.evict()
+        self.remove(evicted)
+
+    # The file is written under a temporary name and renamed, readers never see a partial file
+    # Returns False if the file couldn't be written, with pin=True the written file is pinned
+    def write(self, key, data, pin=False):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'{self.name}: failed to write {key}: {e!r}')
+            return False
+        with self.lock:
+            self.bytes += len(data) - self.files.pop(key, 0)
+            self.files[key] = len(data)
+            if pin:
+                self.pins[key] += 1
+            evicted = self.evict()
+        self.remove(evicted)
+        return True
+
+    # Drops the least recently used files that aren't pinned until the files fit into max_bytes
+    # Must be called with the lock held, returns the keys whose files have to be removed
+    def evict(self):
+        evicted = []
+        if self.bytes > self.max_bytes:
+            for key in list(self.files):
+                if self.bytes <= self.max_bytes:
+                    break
+                if not self.pins[key]:
+                    self.bytes -= self.files.pop(key)
+                    evicted.append(key)
+        return evicted
+
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def size(self):
+        with self.lock:
+            return len(self.files), self.bytes
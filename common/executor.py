@@ -0,0 +1,51 @@
+# Executor for the model inference of a webservice
+import time
+import asyncio
+import logging
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from common.admission import check_ticket
+
+logger = logging.getLogger('snowpark-container-service')
+
+# Dedicated executor for model inference with a bounded work queue
+# Handlers await their result so the event loop keeps serving other requests during inference
+class InferenceExecutor:
+    def __init__(self, max_queue_size, workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+        self.slots = asyncio.Semaphore(max_queue_size)
+        self.in_flight = 0
+        self.counters = Counter()
+
+    async def run(self, fn, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            async with self.slots:
+                submitted = time.perf_counter()
+                def task():
+                    # Work of requests that were dropped while waiting for the executor is skipped
+                    check_ticket()
+                    started = time.perf_counter()
+                    result = fn(*args, **kwargs)
+                    return result, started - submitted, time.perf_counter() - started
+                # The copied context carries the ticket of the request into the inference thread
+                result, queue_wait, execution = await asyncio.get_running_loop().run_in_executor(self.executor, contextvars.copy_context().run, task)
+        finally:
+            self.in_flight -= 1
+        self.counters['tasks'] += 1
+        self.counters['queue_wait_seconds'] += queue_wait
+        self.counters['execution_seconds'] += execution
+        logger.debug(f'{fn.__name__}: queue wait {queue_wait * 1000:.1f} ms, execution {execution * 1000:.1f} ms')
+        return result
+
+    def stats(self):
+        tasks = self.counters['tasks']
+        return {
+            'in_flight': self.in_flight,
+            'tasks': tasks,
+            'queue_wait_seconds': self.counters['queue_wait_seconds'],
+            'execution_seconds': self.counters['execution_seconds'],
+            'mean_queue_wait_seconds': self.counters['queue_wait_seconds'] / tasks if tasks else 0.0,
+            'mean_execution_seconds': self.counters['execution_seconds'] / tasks if tasks else 0.0,
+        }
@@ -0,0 +1,96 @@
+# Metrics that all webservices expose on their /metrics endpoint
+# Metrics of a single service, e.g. the request and response sizes of GLM, are defined in its webservice
+import re
+import time
+import threading
+from collections import deque
+import torch
+from prometheus_client import Gauge, Histogram
+from prometheus_client import Counter as MetricCounter
+from prometheus_client.core import GaugeMetricFamily
+
+# Sliding window throughput, e.g. rows or generated tokens per second over the last minute
+class ThroughputMeter:
+    def __init__(self, window=60):
+        self.window = window
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.events.append((time.monotonic(), count))
+
+    def rate(self):
+        with self.lock:
+            while self.events and self.events[0][0] < time.monotonic() - self.window:
+                self.events.popleft()
+            return sum(count for _, count in self.events) / self.window
+
+# Exposes the numbers of the /stats endpoint as gauges
+class StatsCollector:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def flatten(self, stats, prefix=''):
+        for key, value in stats.items():
+            name = re.sub('[^a-zA-Z0-9_]', '_', f'{prefix}{key}')
+            if isinstance(value, dict):
+                yield from self.flatten(value, f'{name}_')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+    def collect(self):
+        for name, value in self.flatten(self.stats()):
+            yield GaugeMetricFamily(name, f'{name} from /stats', value=value)
+
+class GPUCollector:
+    def collect(self):
+        allocated = GaugeMetricFamily('gpu_memory_allocated_bytes', 'GPU memory allocated by tensors', labels=['device'])
+        reserved = GaugeMetricFamily('gpu_memory_reserved_bytes', 'GPU memory reserved by the caching allocator', labels=['device'])
+        for device in range(torch.cuda.device_count()):
+            allocated.add_metric([str(device)], torch.cuda.memory_allocated(device))
+            reserved.add_metric([str(device)], torch.cuda.memory_reserved(device))
+        yield allocated
+        yield reserved
+
+latency_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+request_latency = Histogram('request_latency_seconds', 'Latency of service function requests', ['endpoint'], buckets=latency_buckets)
+row_latency = Histogram('row_latency_seconds', 'Latency of service function requests per row', ['endpoint'], buckets=latency_buckets)
+rows_processed = MetricCounter('rows', 'Rows processed by service function requests', ['endpoint'])
+batch_sizes = Histogram('batch_size', 'Number of rows per model call', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+row_throughput = ThroughputMeter()
+Gauge('rows_per_second', 'Rows processed per second over the last minute').set_function(row_throughput.rate)
+
+# Latency and rows of a service function request
+def record_request(endpoint, latency, rows):
+    request_latency.labels(endpoint).observe(latency)
+    row_latency.labels(endpoint).observe(latency / rows)
+    rows_processed.labels(endpoint).inc(rows)
+    row_throughput.add(rows)
+
+# Records latency and rows of every service function request, handlers store the number of rows in request.state
+# observe(request, response) records further metrics of the same requests, e.g. their size
+def install_request_metrics(app, observe=None):
+    @app.middleware("http")
+    async def record_request_metrics(request, call_next):
+        started = time.perf_counter()
+        response = await call_next(request)
+        rows = getattr(request.state, 'rows', None)
+        if rows:
+            record_request(request.url.path, time.perf_counter() - started, rows)
+            if observe is not None:
+                observe(request, response)
+        return response
+
+# Prompt and generated tokens of the LLM services
+class TokenMeter:
+    def __init__(self):
+        self.prompt_tokens = MetricCounter('prompt_tokens', 'Prompt tokens processed')
+        self.generated_tokens = MetricCounter('generated_tokens', 'Tokens generated')
+        self.throughput = ThroughputMeter()
+        Gauge('tokens_per_second', 'Tokens generated per second over the last minute').set_function(self.throughput.rate)
+
+    def record(self, prompt, generated):
+        self.prompt_tokens.inc(prompt)
+        self.generated_tokens.inc(generated)
+        self.throughput.add(generated)
@@ -0,0 +1,218 @@
+# Data-parallel replicas of the model of a webservice in worker processes
+# The webservice splits service function batches across its replicas and forwards whole requests to a single replica
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import subprocess
+from collections import Counter
+import httpx
+import torch
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from common.admission import RequestDropped, current_ticket
+
+logger = logging.getLogger('snowpark-container-service')
+
+# A replica of the model in a worker process, tracks the rows in flight and the time it was busy
+class Replica:
+    def __init__(self, number, port):
+        self.number = number
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.process = None
+        self.in_flight_requests = 0
+        self.in_flight_rows = 0
+        self.busy_since = None
+        self.busy_seconds = 0.0
+        self.counters = Counter()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def begin(self, rows):
+        if self.in_flight_requests == 0:
+            self.busy_since = time.monotonic()
+        self.in_flight_requests += 1
+        self.in_flight_rows += rows
+
+    def end(self, rows, failed=False):
+        self.in_flight_requests -= 1
+        self.in_flight_rows -= rows
+        self.counters['requests'] += 1
+        self.counters['rows'] += rows
+        self.counters['errors'] += failed
+        if self.in_flight_requests == 0:
+            self.busy_seconds += time.monotonic() - self.busy_since
+            self.busy_since = None
+
+    def stats(self, elapsed):
+        busy_seconds = self.busy_seconds + (time.monotonic() - self.busy_since if self.busy_since is not None else 0.0)
+        return {
+            'port': self.port,
+            'alive': self.alive(),
+            'in_flight_requests': self.in_flight_requests,
+            'in_flight_rows': self.in_flight_rows,
+            'requests': self.counters['requests'],
+            'rows': self.counters['rows'],
+            'errors': self.counters['errors'],
+            'busy_seconds': busy_seconds,
+            'utilization': busy_seconds / elapsed if elapsed > 0 else 0.0,
+        }
+
+# Data-parallel replicas of the model behind the endpoints of this webservice
+# Every replica is this webservice in a worker process on an internal port, pinned to one GPU with CUDA_VISIBLE_DEVICES
+# or to a share of the CPUs. Service function batches are split across the replicas by the number of rows every replica
+# has in flight and merged back in the input order
+class ReplicaPool:
+    # app_dir is the directory of the webservice module, forward_headers are the request headers that the replicas understand
+    # and cpus is the number of CPU threads that the replicas share
+    def __init__(self, count, base_port, replica_env, app_dir, forward_headers=('content-type', 'accept'), cpus=None):
+        self.replicas = [Replica(number, base_port + number) for number in range(count)]
+        self.replica_env = replica_env
+        self.app_dir = app_dir
+        self.forward_headers = forward_headers
+        self.cpus = cpus
+        self.client = None
+        self.started = None
+
+    # Starts the worker processes and waits until all replicas are ready, runs in the model loader thread
+    def start(self, timeout=3600):
+        gpus = torch.cuda.device_count()
+        threads = max(1, (self.cpus or len(os.sched_getaffinity(0))) // len(self.replicas))
+        for replica in self.replicas:
+            env = {**os.environ, 'REPLICAS': '1', 'OMP_NUM_THREADS': str(threads), **self.replica_env(replica.number, threads)}
+            if gpus:
+                env['CUDA_VISIBLE_DEVICES'] = str(replica.number % gpus)
+            replica.process = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'webservice:app', '--host', '127.0.0.1', '--port', str(replica.port)],
+                cwd=self.app_dir,
+                env=env
+            )
+        logger.info(f'Started {len(self.replicas)} replicas ' + (f'on {gpus} GPUs' if gpus else f'on CPU with {threads} threads each'))
+        # Replicas load and warm up their models at the same time
+        deadline = time.monotonic() + timeout
+        pending = list(self.replicas)
+        while pending:
+            for replica in list(pending):
+                if not replica.alive():
+                    raise RuntimeError(f'Replica {replica.number} exited with code {replica.process.returncode}')
+                try:
+                    if httpx.get(f'{replica.url}/ready', timeout=5).status_code == 200:
+                        pending.remove(replica)
+                except httpx.HTTPError:
+                    pass
+            if pending and time.monotonic() > deadline:
+                raise TimeoutError(f'Replicas {[replica.number for replica in pending]} not ready after {timeout}s')
+            time.sleep(1)
+        self.started = time.monotonic()
+
+    def shutdown(self):
+        for replica in self.replicas:
+            if replica.alive():
+                replica.process.terminate()
+        for replica in self.replicas:
+            if replica.process is not None:
+                try:
+                    replica.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    replica.process.kill()
+
+    # Returns the sizes of the chunks of a batch per replica, every row goes to the replica with the fewest rows in flight
+    # including the rows already assigned from this batch
+    def assign(self, rows):
+        load = {replica: replica.in_flight_rows for replica in self.replicas if replica.alive()}
+        if not load:
+            raise HTTPException(status_code=503, detail='No replica is available', headers={'Retry-After': '10'})
+        sizes = Counter()
+        for _ in range(rows):
+            replica = min(load, key=load.get)
+            load[replica] += 1
+            sizes[replica] += 1
+        return [(replica, sizes[replica]) for replica in self.replicas if sizes[replica]]
+
+    def request_headers(self, request, ticket):
+        headers = {name: value for name, value in request.headers.items() if name in self.forward_headers}
+        if ticket is not None and ticket.deadline is not None:
+            headers['x-request-timeout'] = f'{max(ticket.remaining(), 0.001):.3f}'
+        return headers
+
+    # Sends one chunk of rows to a replica, errors of the replica are passed on to the client
+    # The replica gets the remaining time until the deadline of the request, dropped requests close the connection to the
+    # replica so that the replica drops its work as well
+    async def post(self, replica, request, rows, loads):
+        ticket = current_ticket.get()
+        replica.begin(len(rows))
+        failed = True
+        try:
+            post = self.client.post(f'{replica.url}{request.url.path}', json={"data": rows}, headers=self.request_headers(request, ticket))
+            response = await (ticket.wait_for(post) if ticket is not None else post)
+            failed = response.status_code != 200
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f'Replica {replica.number} failed: {e!r}')
+        finally:
+            replica.end(len(rows), failed)
+        if failed:
+            # Errors of the replica, e.g. invalid rows, are answered as if this webservice had raised them
+            try:
+                detail = response.json()['detail']
+            except (ValueError, KeyError, TypeError):
+                detail = response.text
+            retry_after = response.headers.get('retry-after')
+            raise HTTPException(status_code=response.status_code, detail=detail, headers={'Retry-After': retry_after} if retry_after else None)
+        return loads(response.content)['data']
+
+    # Splits the rows of a service function call into one contiguous chunk per replica and merges the results in order
+    async def complete_rows(self, request, rows, loads=json.loads):
+        chunks = []
+        start = 0
+        for replica, size in self.assign(len(rows)):
+            chunks.append(self.post(replica, request, rows[start:start + size], loads))
+            start += size
+        return [row for chunk in await asyncio.gather(*chunks) for row in chunk]
+
+    # Forwards a whole request to the replica with the fewest rows in flight, the response is passed through while it is
+    # streamed. Closing the stream, e.g. when the client disconnects, closes the request to the replica as well
+    async def forward(self, request, rows):
+        replica, _ = self.assign(1)[0]
+        content = await request.body()
+        ticket = current_ticket.get()
+        replica.begin(rows)
+        try:
+            upstream_request = self.client.build_request('POST', f'{replica.url}{request.url.path}', content=content, headers=self.request_headers(request, ticket))
+            send = self.client.send(upstream_request, stream=True)
+            upstream = await (ticket.wait_for(send) if ticket is not None else send)
+        except RequestDropped:
+            replica.end(rows, failed=True)
+            raise
+        except httpx.HTTPError as e:
+            replica.end(rows, failed=True)
+            raise HTTPException(status_code=502, detail=f'Replica {replica.number} failed: {e!r}')
+        async def body():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await upstream.aclose()
+                replica.end(rows, failed=upstream.status_code != 200)
+        return StreamingResponse(body(), status_code=upstream.status_code, media_type=upstream.headers.get('content-type'))
+
+    async def replica_stats(self):
+        async def fetch(replica):
+            try:
+                return (await self.client.get(f'{replica.url}/stats', timeout=5)).json()
+            except (httpx.HTTPError, ValueError) as e:
+                return {'error': repr(e)}
+        return dict(zip((f'replica_{replica.number}' for replica in self.replicas), await asyncio.gather(*(fetch(replica) for replica in self.replicas))))
+
+    def error(self):
+        for replica in self.replicas:
+            if replica.process is not None and replica.process.poll() is not None:
+                return f'Replica {replica.number} exited with code {replica.process.returncode}'
+        return None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        return {f'replica_{replica.number}': replica.stats(elapsed) for replica in self.replicas}
@@ -0,0 +1,80 @@
+# Startup of a webservice
+# The port is bound immediately, the model is loaded and warmed up in a background thread
+# Endpoints answer with 503 until the model is ready
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from huggingface_hub import snapshot_download
+
+logger = logging.getLogger('snowpark-container-service')
+
+# Download the model repository to the stage volume, safetensors weights are preferred over pickled weights
+# Returns the local path and whether the weights are available as safetensors
+def download_model(model_id, token=None):
+    if os.path.isdir(model_id):
+        path = model_id
+    else:
+        path = snapshot_download(model_id, token=token, ignore_patterns=['*.bin', '*.pth', '*.pt', '*.h5', '*.msgpack', '*.ot'])
+    if any(name.endswith('.safetensors') for name in os.listdir(path)):
+        return path, True
+    logger.info(f'No safetensors weights found for {model_id}, falling back to pickled weights')
+    return snapshot_download(model_id, token=token), False
+
+class ModelStartup:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.error = None
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, phase):
+        logger.info(f'Startup phase {phase} ...')
+        started = time.perf_counter()
+        yield
+        self.timings[phase] = time.perf_counter() - started
+        logger.info(f'Startup phase {phase} finished in {self.timings[phase]:.1f}s')
+
+    # Loads and warms up the model in this process, or only starts the replicas that load it in worker processes
+    def load_and_warmup(self, load_model, warmup, start_replicas=None):
+        try:
+            if start_replicas is not None:
+                start_replicas()
+            else:
+                load_model()
+                with self.phase('warmup'):
+                    warmup()
+        except Exception as e:
+            self.error = repr(e)
+            logger.exception('Failed to load model')
+            return
+        self.ready.set()
+        logger.info('Model ready. Startup timings: ' + ', '.join(f'{phase} {seconds:.1f}s' for phase, seconds in self.timings.items()))
+
+    def start(self, load_model, warmup, start_replicas=None):
+        threading.Thread(target=self.load_and_warmup, args=(load_model, warmup, start_replicas), name='model-loader', daemon=True).start()
+
+    # Dependency of the endpoints that need the model
+    def check_ready(self):
+        if not self.ready.is_set():
+            raise HTTPException(status_code=503, detail='Model is not loaded yet', headers={'Retry-After': '10'})
+
+    # Adds the /healthz and /ready endpoints, worker_error() returns the error of a worker process that exited
+    def install(self, app, worker_error=None):
+        # Liveness: the process is up, fails only if the model could not be loaded
+        @app.get("/healthz", tags=["Monitoring"])
+        async def healthz():
+            error = self.error or (worker_error() if worker_error is not None else None)
+            if error:
+                return JSONResponse({"status": "failed", "error": error}, status_code=500)
+            return {"status": "ok"}
+
+        # Readiness: the model is loaded and warmed up
+        @app.get("/ready", tags=["Monitoring"])
+        async def ready():
+            if not self.ready.is_set():
+                return JSONResponse({"status": "failed" if self.error else "loading", "startup_seconds": self.timings}, status_code=503)
+            return {"status": "ready", "startup_seconds": self.timings}
@@ -0,0 +1,29 @@
+# Functions that run in the page render process pool of the webservice
+# Worker processes only import this module, so it must not load the model
+from collections import OrderedDict
+import pypdfium2 as pdfium
+
+# Parsed documents are kept open per worker process so consecutive pages don't parse the file again
+max_open_documents = 4
+documents = OrderedDict()
+
+def open_document(path):
+    if path in documents:
+        documents.move_to_end(path)
+        return documents[path]
+    pdf = pdfium.PdfDocument(path)
+    documents[path] = pdf
+    while len(documents) > max_open_documents:
+        _, evicted = documents.popitem(last=False)
+        evicted.close()
+    return pdf
+
+# Render a single page of a PDF, returns the image and the number of pages in the document
+def render_pdf_page(path, page_index, scale):
+    pdf = open_document(path)
+    page = pdf[page_index]
+    bitmap = page.render(
+        scale = scale,  # 1 = 72dpi resolution
+        rotation = 0    # no additional rotation
+    )
+    return bitmap.to_pil(), len(pdf)
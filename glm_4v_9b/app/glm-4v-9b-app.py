@@ -6,12 +6,33 @@ from io import BytesIO
 from PIL import Image
 import pypdfium2 as pdfium
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import json
+import math
+import time
+import codecs
+import threading
 import base64
 from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
 import snowflake.connector
 
+# Files larger than the size limits of the service for images and PDFs are not previewed
+max_image_bytes = int(float(os.getenv('MAX_IMAGE_MB', '20')) * 2**20)
+max_document_bytes = int(float(os.getenv('MAX_DOCUMENT_MB', '50')) * 2**20)
+
+# Size limit of a file by its name or, for uploads, its content
+def file_size_limit(name=None, content=None):
+    is_pdf = content.startswith(b'%PDF') if content is not None else name.lower().endswith('.pdf')
+    return max_document_bytes if is_pdf else max_image_bytes
+# Height of the preview images in pixels, uploaded images are sent to the service at this size as well
+preview_height = 500
+# Number of files that are listed per page of a stage
+stage_files_page_size = 100
+# Time in seconds for which stage listings, files and previews are cached
+cache_ttl = 600
+
 # Function to create a Snowpark session
 @st.cache_resource
 def create_snowpark_session(cache_id):
@@ -50,15 +71,67 @@ def create_snowpark_session(cache_id):
     session = Session.builder.configs({"connection": connection}).create()
     return session
     
-# Function to retrieve an OAuth-Token-header
+# Caches the OAuth-Token-header and refreshes it in the background before it expires
 # Only required if calling SPCS functions directly from an external location
+class TokenCache:
+    def __init__(self, session, refresh_margin=0.2, retry_delay=30):
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.header = None
+        self.expires = 0
+        self.timer = None
+        self.session.sql("ALTER SESSION SET PYTHON_CONNECTOR_QUERY_RESULT_FORMAT = 'json'").collect()
+        # Issue the first token in the background so the first message doesn't wait for it
+        self.schedule(0)
+
+    def fresh(self):
+        # Tokens that expire within the retry delay are treated as expired
+        return self.header is not None and time.monotonic() < self.expires - self.retry_delay
+
+    def refresh(self, force=False):
+        with self.lock:
+            if self.fresh() and not force:
+                return
+            token_data = self.session.connection._rest._token_request('ISSUE')
+            token_extract = token_data["data"]["sessionToken"]
+            validity = token_data["data"].get("validityInSecondsST") or 3600
+            token = f'\"{token_extract}\"'
+            self.header = {'Authorization': f'Snowflake Token={token}'}
+            self.expires = time.monotonic() + validity
+            self.schedule(validity * (1 - self.refresh_margin))
+
+    def background_refresh(self):
+        try:
+            self.refresh(force=True)
+        except Exception:
+            self.schedule(self.retry_delay)
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def get(self):
+        if not self.fresh():
+            self.refresh()
+        return self.header
+
+    def invalidate(self):
+        with self.lock:
+            self.expires = 0
+
+# Function to create the token cache, one per Streamlit server
+@st.cache_resource
+def create_token_cache(_session):
+    return TokenCache(_session)
+
+# Function to retrieve an OAuth-Token-header
 def get_header_token(session):
-    session.sql("ALTER SESSION SET PYTHON_CONNECTOR_QUERY_RESULT_FORMAT = 'json'").collect()
-    token_data = session.connection._rest._token_request('ISSUE')
-    token_extract = token_data["data"]["sessionToken"]
-    token = f'\"{token_extract}\"'
-    header = {'Authorization': f'Snowflake Token={token}'}
-    return header
+    return create_token_cache(session).get()
 
 # Function to reset the conversation state
 def reset():
@@ -68,24 +141,48 @@ def reset():
     content = [{'type': 'text', 'text': 'What can I help you with?'}]
     st.session_state.messages.append({"role": "assistant", "content": content})
 
-# Function to handle uploaded files and convert them to an image
-def file_handler(file_bytes):
-    if file_bytes.startswith((b'\xff\xd8\xff', b'\x89\x50\x4e\x47')):
-        # Handle PNG/JPG images
-        image = Image.open(BytesIO(file_bytes)).convert('RGB')
-    if file_bytes.startswith(b'%PDF'):
-        # Handle PDF files
-        file = pdfium.PdfDocument(file_bytes)
-        n_pages = len(file)
-        page_selection = st.selectbox('Select Page:', list(range(n_pages)))
-        st.session_state.pdf_page = page_selection
-        page = file[page_selection]
-        bitmap = page.render(scale=1, rotation=0)
-        image = bitmap.to_pil()
-    resized_image = resize_image_to_max_height(image, 500)
-    return resized_image
-    
-@st.cache_data
+# Function to check if a file is a PDF document
+def is_pdf(file_bytes):
+    return file_bytes.startswith(b'%PDF')
+
+# Function to render the downsized preview image of a file
+# PDF pages are rendered directly at the preview height and large JPEGs are decoded at a reduced scale
+def render_preview(file_bytes, page_number=0):
+    if is_pdf(file_bytes):
+        document = pdfium.PdfDocument(file_bytes)
+        page = document[page_number]
+        scale = min(1, preview_height / page.get_height())
+        image = page.render(scale=scale, rotation=0).to_pil()
+        document.close()
+    elif file_bytes.startswith((b'\xff\xd8\xff', b'\x89\x50\x4e\x47')) or (file_bytes[:4] == b'RIFF' and file_bytes[8:12] == b'WEBP'):
+        # Handle PNG/JPG/WebP images
+        image = Image.open(BytesIO(file_bytes))
+        if image.format == 'JPEG':
+            image.draft('RGB', (image.width * preview_height // image.height, preview_height))
+        image = image.convert('RGB')
+    else:
+        raise ValueError('Unsupported file type, use JPEG, PNG, WebP or PDF')
+    return resize_image_to_max_height(image, preview_height)
+
+# Function to count the pages of a file, images have no pages
+def count_pages(file_bytes):
+    if not is_pdf(file_bytes):
+        return None
+    document = pdfium.PdfDocument(file_bytes)
+    n_pages = len(document)
+    document.close()
+    return n_pages
+
+# Function to select the page of a file and return its preview image
+def file_handler(n_pages, render_page, key):
+    st.session_state.pdf_page = None
+    if n_pages is None:
+        return render_page(0)
+    page_selection = st.selectbox('Select Page:', list(range(n_pages)), key=key+'_page_selection')
+    st.session_state.pdf_page = page_selection
+    return render_page(page_selection)
+
+@st.cache_data(ttl=cache_ttl)
 # Function to retrieve Snowflake stages
 def retrieve_stages():
     stages = pd.DataFrame(session.sql("SHOW STAGES").collect())
@@ -95,42 +192,78 @@ def retrieve_stages():
     stages = stages['FULL_PATH']
     return stages
 
-@st.cache_data
-# Function to retrieve files from a specified Snowflake stage (only .jpg, .png or .pdf)
-def retrieve_stage_files(stage):
-    files = pd.DataFrame(session.sql(f"SELECT lower(RELATIVE_PATH) REGEXP '.*\.(jpg|png|pdf)$' AS IS_VALID_FILE, * FROM DIRECTORY(@{stage}) WHERE IS_VALID_FILE = TRUE").collect())
-    if len(files) > 0:
-        files = files.sort_values(by=['RELATIVE_PATH'])
-        files = files['RELATIVE_PATH']
-        return files
-    else:
-        st.info('No supported files in stage.')
-        return []
+# Filter for the supported files in a stage directory (only .jpg, .png, .webp or .pdf)
+valid_files_filter = "lower(RELATIVE_PATH) REGEXP '.*\\.(jpg|jpeg|png|webp|pdf)$'"
 
-@st.cache_data
+@st.cache_data(ttl=cache_ttl, max_entries=64)
+# Function to count the supported files in a specified Snowflake stage
+def retrieve_stage_file_count(stage):
+    return session.sql(f"SELECT COUNT(*) AS N_FILES FROM DIRECTORY(@{stage}) WHERE {valid_files_filter}").collect()[0]['N_FILES']
+
+@st.cache_data(ttl=cache_ttl, max_entries=64)
+# Function to retrieve one page of the supported files in a specified Snowflake stage with their sizes
+def retrieve_stage_files(stage, listing_page):
+    offset = listing_page * stage_files_page_size
+    files = session.sql(f"SELECT RELATIVE_PATH, SIZE FROM DIRECTORY(@{stage}) WHERE {valid_files_filter} "
+                        f"ORDER BY RELATIVE_PATH LIMIT {stage_files_page_size} OFFSET {offset}").collect()
+    return {file['RELATIVE_PATH']: file['SIZE'] for file in files}
+
+@st.cache_data(ttl=cache_ttl, max_entries=8, show_spinner=False)
 # Function to retrieve file bytes from a specified Snowflake stage and file
+# Only a few files are kept, together with the file size limit this bounds the memory of the cache
 def retrieve_stage_file_bytes(stage_selection, file_selection):
     file_bytes = session.file.get_stream(f"@{stage_selection}/{file_selection}").read()
     return file_bytes
 
+@st.cache_data(ttl=cache_ttl, max_entries=64, show_spinner=False)
+# Function to count the pages of a file in a specified Snowflake stage
+def retrieve_stage_file_pages(stage_selection, file_selection):
+    return count_pages(retrieve_stage_file_bytes(stage_selection, file_selection))
+
+@st.cache_data(ttl=cache_ttl, max_entries=256, show_spinner=False)
+# Function to retrieve the preview image of a page of a file in a specified Snowflake stage
+def retrieve_stage_preview(stage_selection, file_selection, page_number):
+    return render_preview(retrieve_stage_file_bytes(stage_selection, file_selection), page_number)
+
+@st.cache_data(ttl=cache_ttl, max_entries=16, show_spinner=False)
+# Function to count the pages of an uploaded file
+def uploaded_file_pages(file_bytes):
+    return count_pages(file_bytes)
+
+@st.cache_data(ttl=cache_ttl, max_entries=64, show_spinner=False)
+# Function to render the preview image of a page of an uploaded file
+def uploaded_file_preview(file_bytes, page_number):
+    return render_preview(file_bytes, page_number)
+
 # Function to handle file retrieval from Snowflake
 def get_file_from_snowflake(key):
     st.session_state.base64_image_string = None
     with st.expander('Select a file', expanded=True):
         stages = retrieve_stages()
         stage_selection = st.selectbox('Select Stage:', stages, key=key+'_stage_selection')
-        files = retrieve_stage_files(stage_selection)
-        if len(files) > 0:
-            file_selection = st.selectbox('Select File:', files, key=key+'_file_selection')
-            file_bytes = retrieve_stage_file_bytes(stage_selection, file_selection)
-            image = file_handler(file_bytes)
-            st.image(image)
-            if st.button('Select file', key+'_file_button'):
-                st.session_state.file_url = session.sql(f"SELECT GET_PRESIGNED_URL('@{stage_selection}','{file_selection}') AS FILE_URL").collect()[0]['FILE_URL']
-                st.session_state.image = image
-                st.session_state.file_selection = file_selection
-                st.session_state.messages[-1]['content'][0]['misc'] = image
-                return image
+        n_files = retrieve_stage_file_count(stage_selection)
+        if n_files == 0:
+            st.info('No supported files in stage.')
+            return
+        n_listing_pages = math.ceil(n_files / stage_files_page_size)
+        listing_page = 1
+        if n_listing_pages > 1:
+            listing_page = st.number_input(f'Files page (1-{n_listing_pages}, {n_files} files):', min_value=1, max_value=n_listing_pages, key=key+'_listing_page')
+        files = retrieve_stage_files(stage_selection, listing_page - 1)
+        file_selection = st.selectbox('Select File:', list(files), key=key+'_file_selection')
+        size_limit = file_size_limit(name=file_selection)
+        if files[file_selection] > size_limit:
+            st.error(f'File is larger than {size_limit / 2**20:g} MB.')
+            return
+        n_pages = retrieve_stage_file_pages(stage_selection, file_selection)
+        image = file_handler(n_pages, lambda page_number: retrieve_stage_preview(stage_selection, file_selection, page_number), key)
+        st.image(image)
+        if st.button('Select file', key+'_file_button'):
+            st.session_state.file_url = session.sql(f"SELECT GET_PRESIGNED_URL('@{stage_selection}','{file_selection}') AS FILE_URL").collect()[0]['FILE_URL']
+            st.session_state.image = image
+            st.session_state.file_selection = file_selection
+            st.session_state.messages[-1]['content'][0]['misc'] = image
+            return image
 
 # Function to handle file retrieval from a URL
 def get_file_from_url(key):
@@ -147,49 +280,133 @@ def get_file_from_url(key):
 # Function to handle file upload
 def get_file_from_upload(key):
     try:
-        uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png", "pdf"], key=key+'_uploader')
+        uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png", "webp", "pdf"], key=key+'_uploader')
         if uploaded_file is not None:
             uploaded_file = uploaded_file.getvalue()
-            image = file_handler(uploaded_file)
+            size_limit = file_size_limit(content=uploaded_file)
+            if len(uploaded_file) > size_limit:
+                st.error(f'File is larger than {size_limit / 2**20:g} MB.')
+                return
+            n_pages = uploaded_file_pages(uploaded_file)
+            image = file_handler(n_pages, lambda page_number: uploaded_file_preview(uploaded_file, page_number), key)
             st.image(image, caption='Uploaded Image')
             if st.button('Select File', key+'_upload_button'):
                 st.session_state.image = image
                 st.session_state.file_selection = 'Uploaded File'
                 st.session_state.file_url = None
-                st.session_state.base64_image_string = pil_image_to_base64(image)
+                st.session_state.image_bytes = pil_image_to_jpeg(image)
+                st.session_state.base64_image_string = base64.b64encode(st.session_state.image_bytes).decode("utf-8")
                 st.session_state.messages[-1]['content'][0]['misc'] = image
                 return uploaded_file
     except Exception as e:
         st.error(e)
 
-# Function to convert a PIL image to a base64 encoded string
-def pil_image_to_base64(image: Image.Image) -> str:
+# Function to convert a PIL image to JPEG, which is several times smaller than PNG for photos and rendered pages
+def pil_image_to_jpeg(image: Image.Image, quality: int = 90) -> bytes:
     buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_byte_data = buffered.getvalue()
-    base64_str = base64.b64encode(img_byte_data).decode("utf-8")
-    return base64_str
+    image.convert('RGB').save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+# Function to create a pooled HTTP session that keeps connections to the service alive between requests
+@st.cache_resource
+def create_http_session():
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+# Function to read the decoded text of a streamed response as soon as it arrives
+# The incremental decoder keeps multi-byte characters that are split across chunks instead of dropping them
+def iter_text(response):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=None):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+# Function to parse server-sent events from a streamed response into (event, data) tuples
+def iter_sse_events(response):
+    buffer = ''
+    event, data = None, []
+    for text in iter_text(response):
+        buffer += text
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            line = line.rstrip('\r')
+            if not line:
+                # An empty line ends the event
+                if data:
+                    yield event or 'message', '\n'.join(data)
+                event, data = None, []
+            elif line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:'):
+                data.append(line[6:] if line.startswith('data: ') else line[5:])
 
 # Function to stream response from a given prompt
+# Uploaded images are sent as binary JPEG to the upload endpoint instead of as base64 string
+# Time to first token and tokens per second are measured as rendered by the app
 def streamed_response(prompt):
-    prompt = {'data': [[1, prompt]]}
     if st.session_state.execution_location == 'EXTERNAL':
         llm_url = st.session_state.ingress_url
         header = get_header_token(token_session)
     if st.session_state.execution_location == 'SPCS':
         llm_url = 'http://localhost:9000/complete'
         header = {}
-    with requests.post(llm_url, json=prompt, headers=header, stream=True) as response:
-        if response.status_code == 200:
-            for chunk in response.iter_content():
-                if chunk:  # Filter out keep-alive new chunks
-                    try:
-                        chunk = chunk.decode("utf-8")
-                    except Exception as e:
-                        chunk = ''
-                    yield chunk
+    args = dict(prompt['args'])
+    if args.pop('base64_image_string', None) is not None and st.session_state.image_bytes is not None:
+        request = {
+            'data': {'prompt': prompt['prompt'], 'args': json.dumps(args)},
+            'files': {'image': ('image.jpg', st.session_state.image_bytes, 'image/jpeg')}
+        }
+        llm_url = f'{llm_url}_upload'
+    else:
+        request = {'json': {'data': [[1, prompt]]}}
+    header = {**header, 'Accept': 'text/event-stream'}
+    st.session_state.stream_stats = None
+    requested = time.perf_counter()
+    first_chunk_time = None
+    chunks = 0
+    server_stats = {}
+    response = create_http_session().post(llm_url, **request, headers=header, stream=True, timeout=(10, 300))
+    if response.status_code == 401 and st.session_state.execution_location == 'EXTERNAL':
+        # The token was revoked before it expired, retry once with a new token
+        response.close()
+        create_token_cache(token_session).invalidate()
+        header = {**get_header_token(token_session), 'Accept': 'text/event-stream'}
+        response = create_http_session().post(llm_url, **request, headers=header, stream=True, timeout=(10, 300))
+    with response:
+        if response.status_code != 200:
+            st.error(f'{response.status_code}: {response.text}')
+            return
+        if response.headers.get('content-type', '').startswith('text/event-stream'):
+            events = iter_sse_events(response)
         else:
-            st.error(response.status_code)
+            events = (('message', text) for text in iter_text(response))
+        for event, data in events:
+            if event == 'done':
+                server_stats = json.loads(data)
+            elif event == 'error':
+                st.error(data)
+            elif data:
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter()
+                chunks += 1
+                yield data
+    finished = time.perf_counter()
+    if first_chunk_time is not None:
+        # The server reports the number of generated tokens with server-sent events, otherwise every chunk counts as a token
+        tokens = server_stats.get('generated_tokens') or chunks
+        st.session_state.stream_stats = {
+            'time_to_first_token': first_chunk_time - requested,
+            'tokens_per_second': tokens / (finished - first_chunk_time) if finished > first_chunk_time else None,
+            'generated_tokens': tokens,
+            'server': server_stats,
+        }
 
 # Function to generate a Snowflake query for the given payload
 def query_snowflake(payload):
@@ -293,6 +510,12 @@ def display_content(content: list, message_index: int = None) -> None:
                 if item['misc'] is None:
                     response = st.write_stream(streamed_response(item["query"]))
                     st.session_state['misc'] = response
+                    stream_stats = st.session_state.stream_stats
+                    if stream_stats is not None:
+                        caption = f"Time to first token: {stream_stats['time_to_first_token']:.2f}s"
+                        if stream_stats['tokens_per_second'] is not None:
+                            caption += f" | {stream_stats['tokens_per_second']:.1f} tokens/s"
+                        st.caption(caption)
                 else:
                     st.markdown(item['misc'])
             else:
@@ -347,7 +570,9 @@ session_state_defaults = {
     "misc": None,
     "execution_location": None,
     "ingress_url": False,
-    "base64_image_string": None
+    "base64_image_string": None,
+    "image_bytes": None,
+    "stream_stats": None
 }
 
 # Update session state with default values if not already set
@@ -367,16 +592,27 @@ else:
 session = create_snowpark_session(1)
 token_session = create_snowpark_session(2)
 
-# Function to retrieve the ingress URL for the LLM endpoint
-def retrieve_endpoint():
-    ingress_url = None
+@st.cache_data(ttl=3600, show_spinner=False)
+# Function to look up the ingress URL of the LLM endpoint, the URL doesn't change while the service exists
+def retrieve_ingress_url():
     endpoints = session.sql('SHOW ENDPOINTS IN SERVICE GLM_V4_9B_SERVICE').collect()
     for endpoint in endpoints:
-        if endpoint['name'] == 'api':
-            ingress_url = f"https://{endpoint['ingress_url']}/complete"
+        # The ingress URL is a status message while the endpoint is being provisioned
+        if endpoint['name'] == 'api' and ' ' not in endpoint['ingress_url']:
+            return f"https://{endpoint['ingress_url']}/complete"
+    return None
+
+# Function to retrieve the ingress URL for the LLM endpoint
+def retrieve_endpoint():
+    ingress_url = retrieve_ingress_url()
     if ingress_url is not None:
         st.session_state.ingress_url = ingress_url
+        if st.session_state.execution_location == 'EXTERNAL':
+            # Issue the token while the user types the first message
+            create_token_cache(token_session)
     else:
+        # Look the URL up again on the next toggle
+        retrieve_ingress_url.clear()
         st.error('Ingress URL is not available.')
 
 # Sidebar content
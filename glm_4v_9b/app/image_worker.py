@@ -0,0 +1,34 @@
+# Functions that run in the image decode process pool of the webservice
+# Worker processes only import this module, so it must not load the model
+import base64
+from io import BytesIO
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+
+shared_buffer = None
+slots = None
+
+# Attaches the shared memory slots that decoded images are written to
+def init_worker(shared_memory_name, slot_count, slot_shape):
+    global shared_buffer, slots
+    # The webservice owns the shared memory and unlinks it on shutdown, spawned workers share its resource tracker
+    shared_buffer = shared_memory.SharedMemory(name=shared_memory_name)
+    slots = np.ndarray((slot_count, *slot_shape), dtype=np.uint8, buffer=shared_buffer.buf)
+
+# Decode an image and resize it to the input size of the vision encoder into a shared memory slot
+# Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale directly from the DCT coefficients as long as the result is still
+# at least as large as the input size, unless the full resolution image is returned as base64 PNG as well
+def decode_image(slot, path=None, image_bytes=None, return_png=False):
+    image = Image.open(path if path is not None else BytesIO(image_bytes))
+    height, width = slots.shape[1:3]
+    if image.format == 'JPEG' and not return_png:
+        image.draft('RGB', (width, height))
+    image = image.convert('RGB')
+    base64_png = None
+    if return_png:
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        base64_png = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    slots[slot] = np.asarray(image.resize((width, height), Image.BICUBIC))
+    return base64_png
@@ -1,18 +1,73 @@
 import logging
 import sys
-from fastapi import FastAPI, Request
+import asyncio
+import time
+import json
+import hashlib
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, Histogram, generate_latest
+from common.admission import AdmissionControl, current_ticket, check_ticket
+from common.metrics import TokenMeter, StatsCollector, GPUCollector, batch_sizes, install_request_metrics
+from common.executor import InferenceExecutor
+from common.startup import ModelStartup, download_model
+from common.replicas import ReplicaPool
+from common.cache import DiskCache
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 import torch
+import numpy as np
 from PIL import Image
 import requests
+import httpx
 from io import BytesIO
-from threading import Thread
 from fastapi.responses import StreamingResponse
 import os
 import base64
-import pypdfium2 as pdfium
+import document_worker
+import image_worker
 os.environ['HF_HOME'] = '/llm_models'
 model_id = os.getenv('HUGGINGFACE_MODEL')
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig
+# Maximum number of inference calls that are queued or running at the same time
+inference_queue_size = int(os.getenv('INFERENCE_QUEUE_SIZE', '64'))
+# Streaming: maximum number of concurrent streamed generations and maximum time to wait for the next token
+max_concurrent_streams = int(os.getenv('MAX_CONCURRENT_STREAMS', '2'))
+stream_token_timeout = float(os.getenv('STREAM_TOKEN_TIMEOUT', '60'))
+# Document cache: directory and size for downloaded files, time for which a URL maps to its cached file
+document_cache_dir = os.getenv('DOCUMENT_CACHE_DIR', '/tmp/document_cache')
+document_cache_mb = int(os.getenv('DOCUMENT_CACHE_MB', '1024'))
+document_url_ttl = float(os.getenv('DOCUMENT_URL_TTL', '3600'))
+# Page cache: size of rendered PDF pages, render processes and number of following pages that are rendered ahead
+page_cache_mb = int(os.getenv('PAGE_CACHE_MB', '512'))
+render_workers = int(os.getenv('RENDER_WORKERS', '2'))
+pdf_prefetch_pages = int(os.getenv('PDF_PREFETCH_PAGES', '0'))
+# Image decoding: worker processes (0 decodes in threads of the webservice) and number of images that are decoded
+# at the same time
+decode_workers = int(os.getenv('DECODE_WORKERS', '2'))
+decode_queue_size = int(os.getenv('DECODE_QUEUE_SIZE', '8'))
+# Maximum size of an image in MB, for uploads, base64 strings and downloaded images
+max_image_mb = float(os.getenv('MAX_IMAGE_MB', '20'))
+# Maximum size of a downloaded PDF in MB
+max_document_mb = float(os.getenv('MAX_DOCUMENT_MB', '50'))
+# Size of the cache of base64 PNGs returned with return_image_base64
+return_image_cache_mb = int(os.getenv('RETURN_IMAGE_CACHE_MB', '256'))
+# Number of warmup generations with and without an image that run before the service reports ready, 0 disables the warmup
+warmup_rows = int(os.getenv('WARMUP_ROWS', '1'))
+# Number of model replicas in worker processes behind this webservice, e.g. one per GPU, 1 serves the model in this process
+replicas = int(os.getenv('REPLICAS', '1'))
+# Internal port of the first replica, the following replicas use the next ports
+replica_base_port = int(os.getenv('REPLICA_BASE_PORT', '9100'))
+# Admission control per endpoint: maximum number of requests that run at the same time and that wait for a slot,
+# further requests are rejected with status 429
+max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', '4'))
+max_queued_requests = int(os.getenv('MAX_QUEUED_REQUESTS', '16'))
+# Limits of single endpoints as concurrent:queued requests, e.g. /complete=2:8,/complete_upload=1:4
+endpoint_limits = os.getenv('ENDPOINT_LIMITS', '')
+# Deadline of a request in seconds, clients can send a shorter X-Request-Timeout header, 0 disables the deadline
+request_timeout = float(os.getenv('REQUEST_TIMEOUT', '600'))
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList
 
 # Logging
 def get_logger(logger_name):
@@ -29,35 +84,82 @@ logger = get_logger('snowpark-container-service')
 
 app = FastAPI()
 
+# Metrics of this service, the metrics of all services are defined in common.metrics
+byte_buckets = (1024, 10 * 1024, 100 * 1024, 2**20, 5 * 2**20, 10 * 2**20, 25 * 2**20, 50 * 2**20)
+request_bytes = Histogram('request_bytes', 'Size of service function requests', ['endpoint'], buckets=byte_buckets)
+response_bytes = Histogram('response_bytes', 'Size of service function responses', ['endpoint'], buckets=byte_buckets)
+
+record_tokens = TokenMeter().record
+
 logger.info(f'cuda.is_available(): {torch.cuda.is_available()}')
 logger.info(f'cuda.device_count(): {torch.cuda.device_count()}')
 
 # Define 4bit quantization
 quantization_config = BitsAndBytesConfig(load_in_4bit=True)
 
-# Loading model
-logger.info('Loading Model ...')
-model = AutoModelForCausalLM.from_pretrained(
-    model_id,
-    torch_dtype=torch.bfloat16,
-    low_cpu_mem_usage=True,
-    trust_remote_code=True,
-    quantization_config=quantization_config
-    #load_in_4bit=True
-)
-tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
-streamer = TextIteratorStreamer(tokenizer, timeout=5, skip_prompt=True)
-logger.info('Finished Loading Model.')
-
-def base64_to_pil_image(base64_str: str) -> Image.Image:
-    # Decode the base64 string to bytes
-    img_byte_data = base64.b64decode(base64_str)
-    # Create a BytesIO buffer from the byte data
-    img_buffer = BytesIO(img_byte_data)
-    # Open the image from the buffer using PIL
-    image = Image.open(img_buffer)
-    return image
-    
+# Startup, see common.startup
+model = None
+tokenizer = None
+image_decoder = None
+startup = ModelStartup()
+
+def load_model():
+    global model, tokenizer, image_decoder
+    with startup.phase('download'):
+        model_path, use_safetensors = download_model(model_id)
+    # Weights are quantized while they are placed on the GPU, so this phase includes the device placement.
+    # safetensors files are memory mapped.
+    with startup.phase('weight_load'):
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+            use_safetensors=use_safetensors,
+            quantization_config=quantization_config
+            #load_in_4bit=True
+        )
+        model.eval()
+        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    # Images are resized to the input size of the vision encoder of the tokenizer while they are decoded
+    if decode_workers > 0 and getattr(tokenizer, 'image_size', None):
+        with startup.phase('decode_pool'):
+            image_decoder = ImageDecoder(decode_workers, decode_queue_size, tokenizer.image_size)
+
+# Generate a few tokens with and without an image so that the first request doesn't pay for
+# CUDA kernel selection and allocator growth of the language model and the vision encoder
+def warmup():
+    image = Image.new('RGB', (224, 224))
+    if image_decoder is not None and warmup_rows > 0:
+        image_decoder.warmup(image)
+    for _ in range(warmup_rows):
+        generate_response(prepare_inputs('Hello', None), {'max_new_tokens': 8})
+        generate_response(prepare_inputs('Describe the image.', image), {'max_new_tokens': 8})
+
+# Download the model once, the replicas load it from the stage volume
+def start_replicas():
+    with startup.phase('download'):
+        download_model(model_id)
+    with startup.phase('replicas'):
+        replica_pool.start()
+
+@app.on_event("startup")
+async def start_model_loading():
+    if replica_pool is not None:
+        replica_pool.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10), limits=httpx.Limits(max_connections=None))
+    startup.start(load_model, warmup, start_replicas if replica_pool is not None else None)
+
+# Stops a generate call as soon as its request is dropped, the truncated output is discarded by check_ticket
+class DroppedCriteria(StoppingCriteria):
+    def __init__(self):
+        self.ticket = current_ticket.get()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        dropped = self.ticket is not None and self.ticket.reason() is not None
+        return torch.full((input_ids.shape[0],), dropped, dtype=torch.bool, device=input_ids.device)
+
+admission = AdmissionControl(('/complete', '/complete_upload'), max_concurrent_requests, max_queued_requests, endpoint_limits, request_timeout)
+
 def pil_image_to_base64(image: Image.Image) -> str:
     # Create a BytesIO buffer to hold the image data
     buffered = BytesIO()
@@ -69,74 +171,620 @@ def pil_image_to_base64(image: Image.Image) -> str:
     base64_str = base64.b64encode(img_byte_data).decode("utf-8")
     return base64_str
 
-# Function for streaming LLM output
-def generate_text_stream(generation_args):
-    thread = Thread(target=model.generate, kwargs=generation_args)
-    thread.start()
-    for next_token in streamer:
-        yield next_token.replace('<|endoftext|>','')
-        
-def load_image_from_args(args):
-    if 'file_url' in args:
-        response = requests.get(args['file_url'])
-        file_bytes = BytesIO(response.content)
-        file_bytes_r = file_bytes.read()
-        # if file is PNG or JPEG
-        if file_bytes_r.startswith((b'\xff\xd8\xff', b'\x89\x50\x4e\x47')):
-            image = Image.open(file_bytes).convert('RGB')
-        # if file is PDF
-        if file_bytes_r.startswith(b'%PDF'):
-            pdf = pdfium.PdfDocument(file_bytes_r)
-            page = pdf[args['pdf_page']]
-            # Render the page
-            bitmap = page.render(
-                scale = 1,    # 72dpi resolution
-                rotation = 0  # no additional rotation
-            )
-            image = bitmap.to_pil()
+# Bounded cache of downloaded files on local disk, keyed by content hash
+# URLs are mapped to the content hash of their file so repeated requests skip the download
+# Requests pin the files they read, eviction skips pinned files
+class DocumentCache:
+    def __init__(self, directory, max_bytes, url_ttl):
+        self.files = DiskCache('Document cache', directory, max_bytes, '.bin')
+        self.url_ttl = url_ttl
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def path(self, key):
+        return self.files.path(key)
+
+    # Returns the content hash of a cached URL, the file is pinned until it's released
+    def get_url(self, url):
+        with self.lock:
+            entry = self.urls.get(url)
+            if entry is not None and entry[1] >= time.monotonic() and self.files.pin(entry[0]):
+                self.counters['url_hits'] += 1
+                return entry[0]
+            self.urls.pop(url, None)
+            return None
+
+    # Returns the content hash of the file, the file is pinned until it's released
+    def put(self, url, content):
+        key = hashlib.sha256(content).hexdigest()
+        known = self.files.pin(key)
+        if not known and not self.files.write(key, content, pin=True):
+            raise OSError(f'Failed to cache {url}')
+        with self.lock:
+            self.counters['content_hits' if known else 'downloads'] += 1
+            self.urls[url] = (key, time.monotonic() + self.url_ttl)
+            self.urls.move_to_end(url)
+            while len(self.urls) > 10000:
+                self.urls.popitem(last=False)
+        return key
+
+    def pin(self, key):
+        return self.files.pin(key)
+
+    def release(self, key):
+        self.files.release(key)
+
+    def head(self, key, size=8):
+        with open(self.path(key), 'rb') as f:
+            return f.read(size)
+
+    def stats(self):
+        files, size = self.files.size()
+        with self.lock:
+            return {**self.counters, 'files': files, 'bytes': size, 'urls': len(self.urls)}
+
+# Bounded cache of rendered PDF pages keyed by content hash, page and scale
+# Pages are rendered in a process pool so rendering doesn't hold the GIL of the webservice
+class PageCache:
+    def __init__(self, max_bytes, workers, prefetch_pages, documents):
+        self.max_bytes = max_bytes
+        self.prefetch_pages = prefetch_pages
+        self.documents = documents
+        self.pages = OrderedDict()
+        self.bytes = 0
+        self.pending = {}
+        self.lock = threading.RLock()
+        self.counters = Counter()
+        # Spawned workers only import document_worker instead of a copy of the whole webservice
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    # Waits for the render on the event loop instead of blocking a thread of the default thread pool
+    async def get(self, key, path, page_index, scale):
+        page_key = (key, page_index, scale)
+        with self.lock:
+            if page_key in self.pages:
+                self.pages.move_to_end(page_key)
+                self.counters['hits'] += 1
+                return self.pages[page_key][0]
+            future = self.pending.get(page_key)
+            if future is None:
+                self.counters['misses'] += 1
+                future = self.submit(page_key, path)
+            else:
+                self.counters['pending_hits'] += 1
+        image, n_pages = await asyncio.wrap_future(future)
+        # Render the following pages ahead of time
+        for next_page in range(page_index + 1, min(page_index + 1 + self.prefetch_pages, n_pages)):
+            next_key = (key, next_page, scale)
+            with self.lock:
+                if next_key not in self.pages and next_key not in self.pending:
+                    self.counters['prefetched'] += 1
+                    self.submit(next_key, path)
+        return image
+
+    # Must be called with the lock held, the caller has pinned the document
+    # Every render pins the document as well, prefetched pages are rendered after the request released it
+    def submit(self, page_key, path):
+        key, page_index, scale = page_key
+        self.documents.pin(key)
+        future = self.pool.submit(document_worker.render_pdf_page, path, page_index, scale)
+        self.pending[page_key] = future
+        future.add_done_callback(lambda future: self.finish(page_key, future))
+        return future
+
+    def finish(self, page_key, future):
+        self.documents.release(page_key[0])
+        with self.lock:
+            self.pending.pop(page_key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            image, _ = future.result()
+            size = image.width * image.height * len(image.getbands())
+            if page_key not in self.pages:
+                self.pages[page_key] = (image, size)
+                self.bytes += size
+            while self.bytes > self.max_bytes and len(self.pages) > 1:
+                _, (_, evicted_size) = self.pages.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'pages': len(self.pages), 'bytes': self.bytes, 'pending': len(self.pending)}
+
+# With replicas, every replica caches the downloaded files in its own directory
+document_cache = DocumentCache(document_cache_dir, document_cache_mb * 2**20, document_url_ttl) if replicas <= 1 else None
+page_cache = PageCache(page_cache_mb * 2**20, render_workers, pdf_prefetch_pages, document_cache)
+http_session = requests.Session()
+
+@app.on_event("shutdown")
+def shutdown_render_pool():
+    page_cache.pool.shutdown(cancel_futures=True)
+
+# Decodes images in a process pool so that large images don't hold the GIL of the webservice
+# Workers write the images, resized to the input size of the vision encoder, into shared memory slots instead of
+# pickling them back. The slots bound the number of images that are decoded at the same time, callers wait for a free slot
+# on the event loop, so waiting requests don't hold threads of the default thread pool
+class ImageDecoder:
+    def __init__(self, workers, queue_size, image_size):
+        slot_shape = (image_size, image_size, 3)
+        self.shared_buffer = shared_memory.SharedMemory(create=True, size=queue_size * int(np.prod(slot_shape)))
+        self.slots = np.ndarray((queue_size, *slot_shape), dtype=np.uint8, buffer=self.shared_buffer.buf)
+        self.free_slots = asyncio.Queue()
+        for slot in range(queue_size):
+            self.free_slots.put_nowait(slot)
+        self.queue_size = queue_size
+        self.workers = workers
+        self.counters = Counter()
+        # Spawned workers only import image_worker instead of a copy of the whole webservice
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=image_worker.init_worker,
+            initargs=(self.shared_buffer.name, queue_size, slot_shape)
+        )
+
+    # Returns the decoded image and, if requested, the base64 PNG of the full resolution image
+    async def decode(self, path=None, image_bytes=None, return_png=False):
+        waiting = time.perf_counter()
+        slot = await self.free_slots.get()
+        started = time.perf_counter()
+        future = self.pool.submit(image_worker.decode_image, slot, path, image_bytes, return_png)
+        try:
+            base64_png = await asyncio.wrap_future(future)
+            # RGB images are copied out of the slot, so the slot can be reused right away
+            image = Image.fromarray(self.slots[slot])
+        except asyncio.CancelledError:
+            # A running worker still writes into the slot, the slot is freed once the worker is done
+            loop = asyncio.get_running_loop()
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.free_slots.put_nowait, slot))
+            raise
+        except Exception:
+            self.free_slots.put_nowait(slot)
+            self.counters['failed'] += 1
+            raise
+        self.free_slots.put_nowait(slot)
+        self.counters['images'] += 1
+        self.counters['slot_wait_seconds'] += started - waiting
+        self.counters['decode_seconds'] += time.perf_counter() - started
+        return image, base64_png
+
+    # Starts all workers before the service reports ready
+    def warmup(self, image):
+        buffered = BytesIO()
+        image.save(buffered, format="JPEG")
+        futures = [self.pool.submit(image_worker.decode_image, slot, None, buffered.getvalue(), False) for slot in range(min(self.workers, self.queue_size))]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.slots = None
+        self.shared_buffer.close()
+        self.shared_buffer.unlink()
+
+    def stats(self):
+        images = self.counters['images']
+        return {
+            **self.counters,
+            'free_slots': self.free_slots.qsize(),
+            'queue_size': self.queue_size,
+            'mean_decode_seconds': self.counters['decode_seconds'] / images if images else 0.0,
+        }
+
+@app.on_event("shutdown")
+def shutdown_image_decoder():
+    if image_decoder is not None:
+        image_decoder.shutdown()
+
+# Bounded cache of the base64 PNGs of return_image_base64, keyed by the content hash of the source image
+class ReturnImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.counters['hits'] += 1
+                return self.images[key]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, base64_png):
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = base64_png
+            self.bytes += len(base64_png)
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'images': len(self.images), 'bytes': self.bytes}
+
+return_image_cache = ReturnImageCache(return_image_cache_mb * 2**20)
+max_image_bytes = int(max_image_mb * 2**20)
+max_document_bytes = int(max_document_mb * 2**20)
+
+def check_image_size(size):
+    if size > max_image_bytes:
+        raise HTTPException(status_code=413, detail=f'Image is larger than {max_image_mb:g} MB')
+
+def check_document_size(size):
+    if size > max_document_bytes:
+        raise HTTPException(status_code=413, detail=f'Document is larger than {max_document_mb:g} MB')
+
+# Download a file unless its URL is already cached, returns the content hash of the file
+# The file is pinned, the caller releases it once it has read the file
+def load_file(url):
+    key = document_cache.get_url(url)
+    if key is not None:
+        return key
+    with http_session.get(url, stream=True) as response:
+        response.raise_for_status()
+        content_length = int(response.headers.get('content-length', 0))
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=2**16):
+            content.extend(chunk)
+            # The announced size is checked with the first chunk, once the file type is known
+            check_download_size(content[:12], max(len(content), content_length))
+    return document_cache.put(url, bytes(content))
+
+# JPEG, PNG or WebP
+def is_raster_image(header):
+    return header.startswith((b'\xff\xd8\xff', b'\x89\x50\x4e\x47')) or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+
+# Downloads are checked against the limit of their file type, which is known from the first bytes
+# Unsupported types are rejected after the download, the larger limit applies to them
+def check_download_size(header, size):
+    if header.startswith(b'%PDF'):
+        check_document_size(size)
+    elif is_raster_image(header):
+        check_image_size(size)
+    elif size > max(max_image_bytes, max_document_bytes):
+        raise HTTPException(status_code=413, detail=f'File is larger than {max(max_image_mb, max_document_mb):g} MB')
+
+# Returns the image of the row and, with return_image_base64, the base64 PNG of the image
+# The image is read from file_url, base64_image_string or the bytes of an uploaded image
+# Downloads and encoding run in the default thread pool, decoding and rendering in their process pools
+async def load_image_from_args(args, image_bytes=None):
+    loop = asyncio.get_running_loop()
     if 'base64_image_string' in args:
-        image = base64_to_pil_image(args['base64_image_string']).convert('RGB')
-    return image
+        check_image_size(len(args['base64_image_string']) * 3 // 4)
+        image_bytes = await loop.run_in_executor(None, base64.b64decode, args['base64_image_string'])
+    if image_bytes is not None:
+        key = await loop.run_in_executor(None, content_hash, image_bytes)
+        return await load_image(args, key, image_bytes=image_bytes)
+    download = loop.run_in_executor(None, load_file, args['file_url'])
+    try:
+        key = await asyncio.shield(download)
+    except asyncio.CancelledError:
+        # The downloaded file is pinned, it's released once the download is done
+        download.add_done_callback(lambda download: download.cancelled() or download.exception() is not None or document_cache.release(download.result()))
+        raise
+    try:
+        file_header = await loop.run_in_executor(None, document_cache.head, key, 12)
+        # if file is PDF
+        if file_header.startswith(b'%PDF'):
+            page, scale = args.get('pdf_page', 0), args.get('pdf_scale', 1)
+            image = await page_cache.get(key, document_cache.path(key), page, scale)
+            return await load_image(args, f'{key}-{page}-{scale}', image=image)
+        if is_raster_image(file_header):
+            return await load_image(args, key, path=document_cache.path(key))
+        raise HTTPException(status_code=415, detail='Unsupported file type, use JPEG, PNG, WebP or PDF')
+    finally:
+        document_cache.release(key)
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def open_image(path=None, image_bytes=None):
+    return Image.open(path if path is not None else BytesIO(image_bytes)).convert('RGB')
+
+# Decodes the image from path or image_bytes unless it's a rendered page, key identifies the image in the return image cache
+async def load_image(args, key, path=None, image_bytes=None, image=None):
+    loop = asyncio.get_running_loop()
+    return_png = bool(args.get('return_image_base64'))
+    base64_png = return_image_cache.get(key) if return_png else None
+    if image is None:
+        # PNGs are only encoded by the decoder if they aren't cached yet
+        encode_png = return_png and base64_png is None
+        if image_decoder is not None:
+            image, decoded_png = await image_decoder.decode(path=path, image_bytes=image_bytes, return_png=encode_png)
+            base64_png = base64_png or decoded_png
+        else:
+            image = await loop.run_in_executor(None, open_image, path, image_bytes)
+    if return_png and base64_png is None:
+        base64_png = await loop.run_in_executor(None, pil_image_to_base64, image)
+    if return_png:
+        return_image_cache.put(key, base64_png)
+    return image, base64_png
+
+inference_executor = InferenceExecutor(inference_queue_size)
+
+# Every replica keeps its downloaded files in its own directory
+def replica_env(number, threads):
+    return {'DOCUMENT_CACHE_DIR': os.path.join(document_cache_dir, f'replica_{number}')}
+
+replica_pool = ReplicaPool(replicas, replica_base_port, replica_env, os.path.dirname(os.path.abspath(__file__))) if replicas > 1 else None
+
+@app.on_event("shutdown")
+async def shutdown_replicas():
+    if replica_pool is not None:
+        replica_pool.shutdown()
+        await replica_pool.client.aclose()
+
+# Streamer that records when the first token was generated and how many tokens were generated
+class TimedStreamer(TextIteratorStreamer):
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.generated_tokens = 0
+        self.first_token_time = None
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.generated_tokens += value.numel()
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+        super().put(value)
+
+# Stops a streamed generation once its client is gone
+class CancelledCriteria(StoppingCriteria):
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+# Format a chunk of streamed text as a server-sent event
+def sse_event(data, event=None):
+    lines = [f'event: {event}'] if event else []
+    lines.extend(f'data: {line}' for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+# Runs streamed generations, every request gets its own streamer
+# Generation runs in the inference executor like every other generate call, so streams and service function calls
+# take turns on the GPU instead of running at the same time
+class StreamingEngine:
+    def __init__(self, max_concurrent_streams, token_timeout):
+        self.slots = asyncio.Semaphore(max_concurrent_streams)
+        self.token_timeout = token_timeout
+        self.active = 0
+        self.counters = Counter()
+        self.recent = deque(maxlen=100)
+
+    async def stream(self, request, inputs, generation_args, sse=False):
+        loop = asyncio.get_running_loop()
+        requested = time.perf_counter()
+        streamer = TimedStreamer(tokenizer, timeout=self.token_timeout, skip_prompt=True)
+        cancelled = threading.Event()
+        started = asyncio.Event()
+        completed = False
+        async with self.slots:
+            self.active += 1
+            generation_args = {
+                **inputs,
+                **generation_args,
+                'streamer': streamer,
+                'stopping_criteria': StoppingCriteriaList([CancelledCriteria(cancelled)]),
+            }
+            def generate_stream():
+                loop.call_soon_threadsafe(started.set)
+                with torch.no_grad():
+                    model.generate(**generation_args)
+            generation = asyncio.ensure_future(inference_executor.run(generate_stream))
+            waiter = asyncio.ensure_future(started.wait())
+            try:
+                # The token timeout applies once the generation left the queue of the inference executor
+                await asyncio.wait((generation, waiter), return_when=asyncio.FIRST_COMPLETED)
+                while started.is_set():
+                    text = await loop.run_in_executor(None, next, streamer, None)
+                    if text is None:
+                        break
+                    if await request.is_disconnected():
+                        break
+                    text = text.replace('<|endoftext|>', '')
+                    if text:
+                        yield sse_event(text) if sse else text
+                if await request.is_disconnected():
+                    return
+                await generation
+                completed = True
+                stats = self.record(streamer, inputs, requested, completed)
+                if sse:
+                    yield sse_event(json.dumps(stats), event='done')
+            except Exception as e:
+                logger.exception('Streamed generation failed')
+                if sse:
+                    yield sse_event(repr(e), event='error')
+            finally:
+                # Stop generating when the client disconnected or the stream failed, queued generations are not started
+                cancelled.set()
+                waiter.cancel()
+                generation.cancel()
+                self.active -= 1
+                if not completed:
+                    self.record(streamer, inputs, requested, completed)
+
+    def record(self, streamer, inputs, requested, completed):
+        finished = time.perf_counter()
+        record_tokens(inputs['input_ids'].shape[1], streamer.generated_tokens)
+        first_token_time = streamer.first_token_time
+        stats = {
+            'completed': completed,
+            'generated_tokens': streamer.generated_tokens,
+            'time_to_first_token': first_token_time - requested if first_token_time else None,
+            'tokens_per_second': streamer.generated_tokens / (finished - first_token_time) if first_token_time and finished > first_token_time else None,
+        }
+        self.counters['streams'] += 1
+        self.counters['completed' if completed else 'cancelled'] += 1
+        self.counters['generated_tokens'] += streamer.generated_tokens
+        self.recent.append(stats)
+        logger.info(f'Stream finished: {stats}')
+        return stats
+
+    def stats(self):
+        ttfts = [stats['time_to_first_token'] for stats in self.recent if stats['time_to_first_token'] is not None]
+        rates = [stats['tokens_per_second'] for stats in self.recent if stats['tokens_per_second'] is not None]
+        return {
+            'active': self.active,
+            **self.counters,
+            'mean_time_to_first_token': sum(ttfts) / len(ttfts) if ttfts else None,
+            'mean_tokens_per_second': sum(rates) / len(rates) if rates else None,
+        }
 
-@app.post("/complete", tags=["Endpoints"])
+streaming_engine = StreamingEngine(max_concurrent_streams, stream_token_timeout)
+
+# Tokenize the prompt together with the optional image
+def prepare_inputs(prompt, image):
+    # Prepare inputs based on whether an image is included
+    if image:
+        inputs = tokenizer.apply_chat_template([{"role": "user", "image": image, "content": prompt}],
+                                                add_generation_prompt=True, tokenize=True, return_tensors="pt",
+                                                return_dict=True)
+    else:
+        inputs = tokenizer.apply_chat_template([{"role": "user", "content": prompt}],
+                                                add_generation_prompt=True, tokenize=True, return_tensors="pt",
+                                                return_dict=True)
+    return inputs.to('cuda')
+
+def generate_response(inputs, generation_args):
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **generation_args, stopping_criteria=StoppingCriteriaList([DroppedCriteria()]))
+        check_ticket()
+        outputs = outputs[:, inputs['input_ids'].shape[1]:]
+        batch_sizes.observe(1)
+        record_tokens(inputs['input_ids'].shape[1], outputs.shape[1])
+        return tokenizer.decode(outputs[0]).replace('<|endoftext|>', '')
+
+# Generate the response of a single row, streamed rows return a StreamingResponse
+async def complete_row(request, payload, image_bytes=None):
+    # The remaining rows of a dropped request are not downloaded or generated anymore
+    check_ticket()
+    loop = asyncio.get_running_loop()
+    prompt = payload['prompt']
+    args = payload.get('args', {})
+    generation_args = args.get('generation_args', {})
+
+    # Downloads and preprocessing run in the default thread pool, generation in the inference executor
+    has_image = image_bytes is not None or any(key in args for key in ['file_url', 'base64_image_string'])
+    image, base64_png = await load_image_from_args(args, image_bytes) if has_image else (None, None)
+    inputs = await loop.run_in_executor(None, prepare_inputs, prompt, image)
+
+    # Handle streaming response, clients that accept text/event-stream receive server-sent events
+    if args.get('stream'):
+        sse = 'text/event-stream' in request.headers.get('accept', '')
+        return StreamingResponse(
+            streaming_engine.stream(request, inputs, generation_args, sse=sse),
+            media_type="text/event-stream" if sse else "text/plain"
+        )
+
+    # Handle non-streaming response (called via Snowflake Service Function)
+    response = {'LLM_OUTPUT_TEXT': await inference_executor.run(generate_response, inputs, generation_args)}
+    # if user wants to return base64 image
+    if base64_png is not None:
+        response['base64_image'] = base64_png
+    return response
+
+@app.post("/complete", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
 async def complete(request: Request):
     request_body = await request.json()
     request_body = request_body['data']
+    request.state.rows = len(request_body)
+    if replica_pool is not None:
+        # Streamed rows are answered by a single replica
+        if any(payload.get('args', {}).get('stream') for _, payload in request_body):
+            return await replica_pool.forward(request, len(request_body))
+        return {"data": await replica_pool.complete_rows(request, request_body)}
     return_data = []
 
     for index, payload in request_body:
-        prompt = payload['prompt']
-        args = payload.get('args', {})
-        generation_args = args.get('generation_args', {})
+        response = await complete_row(request, payload)
+        if isinstance(response, StreamingResponse):
+            return response
+        return_data.append([index, response])
 
-        image = load_image_from_args(args) if any(key in args for key in ['file_url', 'base64_image_string']) else None
+    return {"data": return_data}
 
-        # Prepare inputs based on whether an image is included
-        if image:
-            inputs = tokenizer.apply_chat_template([{"role": "user", "image": image, "content": prompt}],
-                                                    add_generation_prompt=True, tokenize=True, return_tensors="pt",
-                                                    return_dict=True)
-        else:
-            inputs = tokenizer.apply_chat_template([{"role": "user", "content": prompt}],
-                                                    add_generation_prompt=True, tokenize=True, return_tensors="pt",
-                                                    return_dict=True)
-
-        inputs = inputs.to('cuda')
-
-        # Handle streaming response
-        if args.get('stream'):
-            generation_args = {**inputs, **generation_args, 'streamer': streamer}
-            return StreamingResponse(generate_text_stream(generation_args), media_type="text/plain")
-        
-        # Handle non-streaming response (called via Snowflake Service Function)
-        else:
-            with torch.no_grad():
-                outputs = model.generate(**inputs, **generation_args)
-                outputs = outputs[:, inputs['input_ids'].shape[1]:]
-                response = {'LLM_OUTPUT_TEXT': tokenizer.decode(outputs[0]).replace('<|endoftext|>', '')}
-            # if user wants to return base64 image
-            if 'return_image_base64' in args:
-                response['base64_image'] = pil_image_to_base64(image)
-            return_data.append([index, response])
-    
-    return {"data": return_data}
\ No newline at end of file
+# Binary upload for clients that call the service directly, multipart/form-data with the fields
+# prompt, args (JSON object, same as in /complete) and image (JPEG, PNG or WebP file)
+# Saves the base64 encoding of the image, which makes requests a third larger
+@app.post("/complete_upload", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
+async def complete_upload(request: Request):
+    # Reject oversized uploads before reading them, the form fields take a few KB at most
+    check_image_size(int(request.headers.get('content-length', 0)) - 2**16)
+    request.state.rows = 1
+    if replica_pool is not None:
+        return await replica_pool.forward(request, 1)
+    async with request.form(max_files=1, max_fields=2) as form:
+        payload = {'prompt': form['prompt'], 'args': json.loads(form.get('args') or '{}')}
+        upload = form.get('image')
+        image_bytes = None
+        if upload is not None:
+            check_image_size(upload.size or 0)
+            image_bytes = await upload.read()
+        response = await complete_row(request, payload, image_bytes)
+    if isinstance(response, StreamingResponse):
+        return response
+    return {"data": [[0, response]]}
+
+def service_stats():
+    if replica_pool is not None:
+        return {"replicas": replica_pool.stats(), "admission": admission.stats(), "startup_seconds": startup.timings}
+    return {
+        "admission": admission.stats(),
+        "inference_executor": inference_executor.stats(),
+        "streaming": streaming_engine.stats(),
+        "document_cache": document_cache.stats(),
+        "page_cache": page_cache.stats(),
+        "image_decoding": image_decoder.stats() if image_decoder is not None else {},
+        "return_image_cache": return_image_cache.stats(),
+        "startup_seconds": startup.timings,
+    }
+
+startup.install(app, replica_pool.error if replica_pool is not None else None)
+
+# With replicas, the stats of every replica are included as well
+@app.get("/stats", tags=["Monitoring"])
+async def stats():
+    if replica_pool is not None and startup.ready.is_set():
+        return {**service_stats(), "replica_stats": await replica_pool.replica_stats()}
+    return service_stats()
+
+# Size of every service function request and response
+def record_request_bytes(request, response):
+    endpoint = request.url.path
+    request_bytes.labels(endpoint).observe(int(request.headers.get('content-length', 0)))
+    response.body_iterator = count_response_bytes(response.body_iterator, endpoint)
+
+# Streamed responses have no content length, their size is known once the last chunk is sent
+async def count_response_bytes(body_iterator, endpoint):
+    size = 0
+    try:
+        async for chunk in body_iterator:
+            size += len(chunk)
+            yield chunk
+    finally:
+        response_bytes.labels(endpoint).observe(size)
+
+install_request_metrics(app, record_request_bytes)
+
+# Oversized uploads are rejected by the handler before their body is read
+def oversized_upload(request):
+    return request.url.path == '/complete_upload' and int(request.headers.get('content-length', 0)) - 2**16 > max_image_bytes
+
+admission.install(app, startup.ready.is_set, bypass=oversized_upload)
+
+REGISTRY.register(StatsCollector(service_stats))
+REGISTRY.register(GPUCollector())
+
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
@@ -1,12 +1,44 @@
 import logging
 import sys
-from fastapi import FastAPI, Request
+import asyncio
+import copy
+from collections import Counter
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, Histogram, generate_latest
+from common.admission import AdmissionControl, RequestDropped, current_ticket, wait_for_request
+from common.metrics import TokenMeter, StatsCollector, GPUCollector, batch_sizes, install_request_metrics
+from common.executor import InferenceExecutor
+from common.startup import ModelStartup, download_model
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 import torch
 import os
 os.environ['HF_HOME'] = '/llm_models'
 hf_access_token = os.getenv('HF_TOKEN')
 model_id = os.getenv('HUGGINGFACE_MODEL')
-from transformers import AutoTokenizer, AutoModelForCausalLM
+# Dynamic batching: maximum rows the scheduler collects for one batch and maximum time to wait for more rows
+max_batch_size = int(os.getenv('MAX_BATCH_SIZE', '64'))
+max_wait_ms = float(os.getenv('MAX_WAIT_MS', '50'))
+# Length-bucketed micro-batches: the rows of a batch are sorted by length and split into generate calls of at most
+# TOKEN_BUDGET prompt and generated tokens, maximum generated tokens per row and context length of the model
+token_budget = int(os.getenv('TOKEN_BUDGET', '16384'))
+max_new_tokens = int(os.getenv('MAX_NEW_TOKENS', '1024'))
+max_sequence_length = int(os.getenv('MAX_SEQUENCE_LENGTH', '2048'))
+# Comma separated texts that end a response, e.g. when the model starts a new turn of the conversation
+stop_sequences = [stop for stop in os.getenv('STOP_SEQUENCES', '[|Human|],### Input:,### Instruction:').split(',') if stop]
+# Reuse precomputed key/value caches for the constant instruction prefix of each prompt
+prefix_cache_enabled = os.getenv('PREFIX_CACHE', 'true').lower() == 'true'
+# Maximum number of inference calls that are queued or running at the same time
+inference_queue_size = int(os.getenv('INFERENCE_QUEUE_SIZE', '64'))
+# Number of rows per prompt template of the warmup batch that runs before the service reports ready, 0 disables the warmup
+warmup_rows = int(os.getenv('WARMUP_ROWS', '2'))
+# Admission control per endpoint: maximum number of requests that run at the same time and that wait for a slot,
+# further requests are rejected with status 429
+max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', '4'))
+max_queued_requests = int(os.getenv('MAX_QUEUED_REQUESTS', '16'))
+# Limits of single endpoints as concurrent:queued requests, e.g. /complete=2:8,/complete_custom=1:4
+endpoint_limits = os.getenv('ENDPOINT_LIMITS', '')
+# Deadline of a request in seconds, clients can send a shorter X-Request-Timeout header, 0 disables the deadline
+request_timeout = float(os.getenv('REQUEST_TIMEOUT', '600'))
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList
 
 # Logging
 def get_logger(logger_name):
@@ -23,51 +55,441 @@ logger = get_logger('snowpark-container-service')
 
 app = FastAPI()
 
+# Metrics of this service, the metrics of all services are defined in common.metrics
+padding_efficiency = Histogram('padding_efficiency', 'Share of prompt tokens that are not padding per micro-batch', buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1))
+
+record_tokens = TokenMeter().record
+
 logger.info(f'cuda.is_available(): {torch.cuda.is_available()}')
 logger.info(f'cuda.device_count(): {torch.cuda.device_count()}')
+if max_batch_size * max_sequence_length <= token_budget:
+    logger.warning(f'TOKEN_BUDGET {token_budget} is never reached by {max_batch_size} rows of at most {max_sequence_length} tokens, '
+                   'batches are not split into micro-batches')
 
 # Prompt formatting
 prompt_eng = "### Instruction: Your name is Jais, and you are named after Jebel Jais, the highest mountain in UAE. You are built by Inception and MBZUAI. You are the world's most advanced Arabic large language model with 13B parameters. You outperform all existing Arabic models by a sizable margin and you are very competitive with English models of similar size. You can answer in Arabic and English only. You are a helpful, respectful and honest assistant. When answering, abide by the following guidelines meticulously: Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, explicit, offensive, toxic, dangerous, or illegal content. Do not give medical, legal, financial, or professional advice. Never assist in or promote illegal activities. Always encourage legal and responsible actions. Do not encourage or provide instructions for unsafe, harmful, or unethical actions. Do not create or share misinformation or fake news. Please ensure that your responses are socially unbiased and positive in nature. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information. Prioritize the well-being and the moral integrity of users. Avoid using toxic, derogatory, or offensive language. Maintain a respectful tone. Do not generate, promote, or engage in discussions about adult content. Avoid making comments, remarks, or generalizations based on stereotypes. Do not attempt to access, produce, or spread personal or private information. Always respect user confidentiality. Stay positive and do not say bad things about anything. Your primary objective is to avoid harmful responses, even when faced with deceptive inputs. Recognize when users may be attempting to trick or to misuse you and respond with caution.\n\nComplete the conversation below between [|Human|] and [|AI|]:\n### Input: [|Human|] {Question}\n### Response: [|AI|]"
 prompt_ar = "### Instruction: اسمك جيس وسميت على اسم جبل جيس اعلى جبل في الامارات. تم بنائك بواسطة Inception و MBZUAI. أنت نموذج اللغة العربية الأكثر تقدمًا في العالم مع بارامترات 13B. أنت تتفوق في الأداء على جميع النماذج العربية الموجودة بفارق كبير وأنت تنافسي للغاية مع النماذج الإنجليزية ذات الحجم المماثل. يمكنك الإجابة باللغتين العربية والإنجليزية فقط. أنت مساعد مفيد ومحترم وصادق. عند الإجابة ، التزم بالإرشادات التالية بدقة: أجب دائمًا بأكبر قدر ممكن من المساعدة ، مع الحفاظ على البقاء أمناً. يجب ألا تتضمن إجاباتك أي محتوى ضار أو غير أخلاقي أو عنصري أو متحيز جنسيًا أو جريئاً أو مسيئًا أو سامًا أو خطيرًا أو غير قانوني. لا تقدم نصائح طبية أو قانونية أو مالية أو مهنية. لا تساعد أبدًا في أنشطة غير قانونية أو تروج لها. دائما تشجيع الإجراءات القانونية والمسؤولة. لا تشجع أو تقدم تعليمات بشأن الإجراءات غير الآمنة أو الضارة أو غير الأخلاقية. لا تنشئ أو تشارك معلومات مضللة أو أخبار كاذبة. يرجى التأكد من أن ردودك غير متحيزة اجتماعيًا وإيجابية بطبيعتها. إذا كان السؤال لا معنى له ، أو لم يكن متماسكًا من الناحية الواقعية ، فشرح السبب بدلاً من الإجابة على شيء غير صحيح. إذا كنت لا تعرف إجابة السؤال ، فالرجاء عدم مشاركة معلومات خاطئة. إعطاء الأولوية للرفاهية والنزاهة الأخلاقية للمستخدمين. تجنب استخدام لغة سامة أو مهينة أو مسيئة. حافظ على نبرة محترمة. لا تنشئ أو تروج أو تشارك في مناقشات حول محتوى للبالغين. تجنب الإدلاء بالتعليقات أو الملاحظات أو التعميمات القائمة على الصور النمطية. لا تحاول الوصول إلى معلومات شخصية أو خاصة أو إنتاجها أو نشرها. احترم دائما سرية المستخدم. كن إيجابيا ولا تقل أشياء سيئة عن أي شيء. هدفك الأساسي هو تجنب الاجابات المؤذية ، حتى عند مواجهة مدخلات خادعة. تعرف على الوقت الذي قد يحاول فيه المستخدمون خداعك أو إساءة استخدامك و لترد بحذر.\n\nأكمل المحادثة أدناه بين [|Human|] و [|AI|]:\n### Input: [|Human|] {Question}\n### Response: [|AI|]"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-# Loading model
-logger.info('Loading Model ...')
-tokenizer = AutoTokenizer.from_pretrained(model_id)
-model = AutoModelForCausalLM.from_pretrained(model_id, device_map="auto", trust_remote_code=True, token=hf_access_token)
-logger.info('Finished Loading Model.')
-
-def get_response(text,tokenizer=tokenizer,model=model):
-    input_ids = tokenizer(text, return_tensors="pt").input_ids
-    inputs = input_ids.to(device)
-    input_len = inputs.shape[-1]
-    generate_ids = model.generate(
-        inputs,
-        top_p=0.9,
-        temperature=0.3,
-        max_length=2048-input_len,
-        min_length=input_len + 4,
-        repetition_penalty=1.2,
-        do_sample=True,
-    )
-    response = tokenizer.batch_decode(
-        generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
-    )[0]
-    response = response.split("### Response: [|AI|]")[-1].strip()
+# Startup, see common.startup
+model = None
+tokenizer = None
+startup = ModelStartup()
+
+def load_model():
+    global model, tokenizer
+    with startup.phase('download'):
+        model_path, use_safetensors = download_model(model_id, token=hf_access_token)
+    # The model is sharded over all GPUs, device_map places every shard while it is read,
+    # so this phase includes the device placement. safetensors files are memory mapped.
+    with startup.phase('weight_load'):
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        # Batched generation requires left padding so that all prompts end at the same position
+        tokenizer.padding_side = 'left'
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            device_map="auto",
+            trust_remote_code=True,
+            use_safetensors=use_safetensors,
+            low_cpu_mem_usage=True
+        )
+        model.eval()
+    if prefix_cache_enabled:
+        with startup.phase('prefix_cache'):
+            for language, template in prompts.items():
+                prefix_cache[language] = build_prefix_cache(template)
+                logger.info(f'Cached {len(prefix_cache[language]["input_ids"])} prefix tokens for language {language}')
+
+# Run a short batch per prompt template through the generation path so that the first request doesn't pay for
+# CUDA kernel selection and allocator growth
+def warmup():
+    if warmup_rows <= 0:
+        return
+    for language, template in prompts.items():
+        ids = tokenizer(template.format_map({'Question': 'Hello'})).input_ids
+        generate_ids([ids] * warmup_rows, prefix_cache.get(language), [8] * warmup_rows)
+
+admission = AdmissionControl(('/complete', '/complete_custom'), max_concurrent_requests, max_queued_requests, endpoint_limits, request_timeout)
+
+prompts = {'EN': prompt_eng, 'AR': prompt_ar}
+generation_args = {
+    'top_p': 0.9,
+    'temperature': 0.3,
+    'repetition_penalty': 1.2,
+    'do_sample': True,
+}
+
+# Precompute the key/value cache of the instruction text that precedes the question in a prompt template
+def build_prefix_cache(template):
+    prefix_text = template.split('{Question}')[0]
+    # The last token is dropped because it could be merged with the first token of the question
+    prefix_ids = tokenizer(prefix_text).input_ids[:-1]
+    with torch.no_grad():
+        past_key_values = model(torch.tensor([prefix_ids], device=device), use_cache=True).past_key_values
+    return {'input_ids': prefix_ids, 'past_key_values': past_key_values}
+
+prefix_cache = {}
+prefix_stats = Counter()
+micro_batch_stats = Counter()
+early_stop_stats = Counter()
+
+# Repeat the cached prefix for every row of a batch, generate() extends the cache in place so it is always copied
+def expand_past_key_values(past_key_values, batch_size):
+    if isinstance(past_key_values, tuple):
+        return tuple(
+            tuple(tensor.expand(batch_size, *tensor.shape[1:]).contiguous() for tensor in layer)
+            for layer in past_key_values
+        )
+    past_key_values = copy.deepcopy(past_key_values)
+    past_key_values.batch_repeat_interleave(batch_size)
+    return past_key_values
+
+# Returns the language whose cached prefix the tokenized prompt starts with
+def match_prefix(ids):
+    for language, prefix in prefix_cache.items():
+        prefix_ids = prefix['input_ids']
+        if len(ids) > len(prefix_ids) and ids[:len(prefix_ids)] == prefix_ids:
+            return language
+    return None
+
+# Stops every row of a batch at its own token limit, as soon as it generated one of the stop sequences or its request
+# is dropped. Only the last generated tokens of each row are decoded, long enough to contain the longest stop sequence
+class RowStoppingCriteria(StoppingCriteria):
+    def __init__(self, input_len, limits, tickets=None):
+        self.input_len = input_len
+        self.limits = limits
+        self.tickets = tickets or [None] * len(limits)
+        self.tail_tokens = max((len(tokenizer(stop).input_ids) for stop in stop_sequences), default=0) + 2
+        self.finished_at = [None] * len(limits)
+        self.stopped = [False] * len(limits)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.input_len
+        tails = []
+        if stop_sequences:
+            tails = tokenizer.batch_decode(input_ids[:, max(self.input_len, input_ids.shape[1] - self.tail_tokens):], skip_special_tokens=True)
+        for row, limit in enumerate(self.limits):
+            if self.finished_at[row] is not None:
+                continue
+            if tails and any(stop in tails[row] for stop in stop_sequences):
+                self.stopped[row] = True
+                self.finished_at[row] = generated
+            elif generated >= limit or input_ids[row, -1].item() == tokenizer.eos_token_id:
+                self.finished_at[row] = generated
+            elif self.tickets[row] is not None and self.tickets[row].reason() is not None:
+                self.finished_at[row] = generated
+        done = [finished_at is not None for finished_at in self.finished_at]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+# Cut a response at the first stop sequence
+def truncate_at_stop(response):
+    for stop in stop_sequences:
+        response = response.split(stop)[0]
     return response
-   
-@app.post("/complete", tags=["Endpoints"])
+
+# Left-pads a batch of tokenized prompts that share the same prefix. With a cached prefix, the prefix keys and values
+# are repeated for every row and extended with everything but the last token, generate() continues from the cache.
+# Jais uses ALiBi, whose bias depends on the token index: padding between the prefix and the rest of a prompt would
+# change the distance between them, so rows that share a cached prefix must all have the same length
+def prepare_batch(rows, prefix=None):
+    prefix_ids = prefix['input_ids'] if prefix else []
+    prefix_len = len(prefix_ids)
+    length = max(len(ids) for ids in rows)
+    if prefix and any(len(ids) != length for ids in rows):
+        raise ValueError('Rows that share a cached prefix must have the same length')
+    input_ids = torch.tensor([[tokenizer.pad_token_id] * (length - len(ids)) + ids for ids in rows], device=device)
+    attention_mask = torch.tensor([[0] * (length - len(ids)) + [1] * len(ids) for ids in rows], device=device)
+    past_key_values = None
+    if prefix:
+        past_key_values = expand_past_key_values(prefix['past_key_values'], len(rows))
+        if length - prefix_len > 1:
+            with torch.no_grad():
+                past_key_values = model(
+                    input_ids=input_ids[:, prefix_len:-1],
+                    attention_mask=attention_mask[:, :-1],
+                    past_key_values=past_key_values,
+                    use_cache=True
+                ).past_key_values
+        prefix_stats['saved_prefill_tokens'] += prefix_len * len(rows)
+        prefix_stats['rows_with_prefix'] += len(rows)
+    else:
+        prefix_stats['rows_without_prefix'] += len(rows)
+    return input_ids, attention_mask, past_key_values
+
+# Generate a batch of tokenized prompts that share the same prefix, returns only the generated tokens
+def generate_ids(rows, prefix=None, limits=None, tickets=None):
+    input_ids, attention_mask, past_key_values = prepare_batch(rows, prefix)
+    input_len = input_ids.shape[-1]
+    # Every row has its own output budget, only limited by the context length of the model
+    limits = [max(1, min(limit or max_new_tokens, max_sequence_length - input_len)) for limit in (limits or [None] * len(rows))]
+    stopping_criteria = RowStoppingCriteria(input_len, limits, tickets)
+    output_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        past_key_values=past_key_values,
+        max_new_tokens=max(limits),
+        min_new_tokens=min(4, min(limits)),
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([stopping_criteria]),
+        **generation_args,
+    )
+    output_ids = output_ids[:, input_len:]
+    # Tokens that stop sequences saved compared to generating up to the row limit, and decoding steps
+    # of the whole micro-batch saved because all rows finished before the largest limit
+    for limit, finished_at, stopped in zip(limits, stopping_criteria.finished_at, stopping_criteria.stopped):
+        if stopped:
+            early_stop_stats['stopped_rows'] += 1
+            early_stop_stats['saved_tokens'] += limit - finished_at
+    if any(stopping_criteria.stopped):
+        early_stop_stats['saved_decoding_steps'] += max(limits) - output_ids.shape[1]
+    batch_sizes.observe(len(rows))
+    prompt_token_count = attention_mask.sum().item()
+    efficiency = prompt_token_count / attention_mask.numel()
+    padding_efficiency.observe(efficiency)
+    micro_batch_stats['micro_batches'] += 1
+    micro_batch_stats['prompt_tokens'] += prompt_token_count
+    micro_batch_stats['padded_prompt_tokens'] += attention_mask.numel()
+    logger.debug(f'Micro-batch of {len(rows)} rows with {input_len} tokens, padding efficiency {efficiency:.0%}')
+    record_tokens(attention_mask.sum().item(), (output_ids != tokenizer.pad_token_id).sum().item())
+    return output_ids
+
+# Split rows into micro-batches of similar length that fit the token budget
+# Rows are sorted by length so that every micro-batch needs little padding, returns lists of row positions
+# Rows that share a cached prefix are only batched with rows of the same length, see prepare_batch
+def plan_micro_batches(lengths, limits, same_length=False):
+    micro_batches = []
+    micro_batch = []
+    longest_output = 0
+    for position in sorted(range(len(lengths)), key=lambda position: lengths[position]):
+        # Rows are sorted, the new row is the longest one of the micro-batch
+        output = max(longest_output, limits[position])
+        tokens = (len(micro_batch) + 1) * min(lengths[position] + output, max_sequence_length)
+        if micro_batch and (tokens > token_budget or (same_length and lengths[position] != lengths[micro_batch[-1]])):
+            micro_batches.append(micro_batch)
+            micro_batch = []
+            output = limits[position]
+        micro_batch.append(position)
+        longest_output = output
+    if micro_batch:
+        micro_batches.append(micro_batch)
+    return micro_batches
+
+# Generate responses for a batch of rows of (prompt, max_new_tokens), results keep the input order
+# Micro-batches whose rows all belong to dropped requests are skipped, their responses stay None
+# Rows of micro-batches that failed get the exception as their response
+def get_responses(rows, tickets=None):
+    tickets = tickets or [None] * len(rows)
+    encoded = tokenizer([text for text, _ in rows]).input_ids
+    limits = [limit or max_new_tokens for _, limit in rows]
+    groups = {}
+    for position, ids in enumerate(encoded):
+        groups.setdefault(match_prefix(ids), []).append(position)
+    responses = [None] * len(rows)
+    for language, positions in groups.items():
+        micro_batches = plan_micro_batches([len(encoded[position]) for position in positions], [limits[position] for position in positions], language in prefix_cache)
+        for micro_batch in micro_batches:
+            micro_batch = [positions[index] for index in micro_batch]
+            if all(tickets[position] is not None and tickets[position].reason() is not None for position in micro_batch):
+                continue
+            try:
+                output_ids = generate_ids(
+                    [encoded[position] for position in micro_batch],
+                    prefix_cache.get(language),
+                    [limits[position] for position in micro_batch],
+                    [tickets[position] for position in micro_batch]
+                )
+                # Only the generated tokens are decoded
+                decoded = tokenizer.batch_decode(
+                    output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
+                )
+            except Exception as e:
+                # Only the rows of the failed micro-batch fail, their requests are answered with the error
+                logger.exception(f'Micro-batch of {len(micro_batch)} rows failed')
+                for position in micro_batch:
+                    responses[position] = e
+                continue
+            for position, response in zip(micro_batch, decoded):
+                responses[position] = truncate_at_stop(response).strip()
+    return responses
+
+inference_executor = InferenceExecutor(inference_queue_size)
+
+# Scheduler that collects prompts from all in-flight requests and generates them in batches
+class BatchScheduler:
+    def __init__(self, process_batch, max_batch_size, max_wait_ms):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.batch_sizes = Counter()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        return asyncio.create_task(self.run())
+
+    # Every row keeps the ticket of its request, rows of dropped requests are not generated
+    async def submit(self, row):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future, current_ticket.get()))
+        return await future
+
+    async def collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            elif timeout > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.collect_batch()
+            for _, future, ticket in batch:
+                if not future.done() and ticket is not None and ticket.reason() is not None:
+                    future.set_exception(RequestDropped(ticket.reason()))
+            batch = [(row, future, ticket) for row, future, ticket in batch if not future.done()]
+            if not batch:
+                continue
+            self.batch_sizes[len(batch)] += 1
+            logger.debug(f'Generating batch of {len(batch)} rows ({self.queue.qsize()} waiting)')
+            try:
+                results = await inference_executor.run(self.process_batch, [row for row, _, _ in batch], [ticket for _, _, ticket in batch])
+            except Exception as e:
+                logger.exception('Batch generation failed')
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            # Rows whose request was dropped during generation are cut short, their responses are discarded
+            for (_, future, ticket), result in zip(batch, results):
+                if future.done():
+                    continue
+                if ticket is not None and ticket.reason() is not None:
+                    future.set_exception(RequestDropped(ticket.reason()))
+                elif isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        batches = sum(self.batch_sizes.values())
+        rows = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'batches': batches,
+            'rows': rows,
+            'mean_batch_size': rows / batches if batches else 0.0,
+            'batch_size_distribution': dict(sorted(self.batch_sizes.items())),
+        }
+
+scheduler = BatchScheduler(get_responses, max_batch_size, max_wait_ms)
+
+@app.on_event("startup")
+async def start_scheduler():
+    startup.start(load_model, warmup)
+    scheduler.start()
+
+# Rows are validated before they are queued, so that a bad row fails its own request with 400 instead of the batch
+# that it would share with the rows of other requests
+def check_row(row, fields):
+    if not isinstance(row, list) or len(row) != len(fields):
+        raise HTTPException(status_code=400, detail=f'Rows must have the values {", ".join(fields)}, got {row!r}')
+    index, input_prompt, language = row[:3]
+    if not isinstance(input_prompt, str):
+        raise HTTPException(status_code=400, detail=f'Row {index}: input_prompt must be a string')
+    if language not in prompts:
+        raise HTTPException(status_code=400, detail=f'Row {index}: unknown language {language!r}, use {" or ".join(prompts)}')
+
+# Returns max_new_tokens as an int, None uses MAX_NEW_TOKENS
+def check_max_new_tokens(index, value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value) or value < 1:
+        raise HTTPException(status_code=400, detail=f'Row {index}: max_new_tokens must be a positive integer, got {value!r}')
+    return int(value)
+
+@app.post("/complete", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
 async def complete(request: Request):
    # input_prompt
    request_body = await request.json()
    request_body = request_body['data']
-   return_data = []
+   request.state.rows = len(request_body)
+   for row in request_body:
+        check_row(row, ('index', 'input_prompt', 'language'))
+   indices = []
+   tasks = []
    for index, input_prompt, language  in request_body:
-        if language == 'EN':
-            formatted_prompt = prompt_eng.format_map({'Question':input_prompt})
-            response = get_response(formatted_prompt)
-        if language == 'AR':
-            formatted_prompt = prompt_ar.format_map({'Question':input_prompt})
-            response = get_response(formatted_prompt)
-        return_data.append([index, response])
-   return {"data": return_data}
\ No newline at end of file
+        formatted_prompt = prompts[language].format_map({'Question':input_prompt})
+        indices.append(index)
+        tasks.append(scheduler.submit((formatted_prompt, None)))
+   responses = await wait_for_request(asyncio.gather(*tasks))
+   return_data = [[index, response] for index, response in zip(indices, responses)]
+   return {"data": return_data}
+
+@app.post("/complete_custom", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
+async def complete_custom(request: Request):
+   # input_prompt, language, max_new_tokens
+   request_body = await request.json()
+   request_body = request_body['data']
+   request.state.rows = len(request_body)
+   limits = []
+   for row in request_body:
+        check_row(row, ('index', 'input_prompt', 'language', 'max_new_tokens'))
+        limits.append(check_max_new_tokens(row[0], row[3]))
+   indices = []
+   tasks = []
+   for (index, input_prompt, language, _), limit  in zip(request_body, limits):
+        formatted_prompt = prompts[language].format_map({'Question':input_prompt})
+        indices.append(index)
+        tasks.append(scheduler.submit((formatted_prompt, limit)))
+   responses = await wait_for_request(asyncio.gather(*tasks))
+   return_data = [[index, response] for index, response in zip(indices, responses)]
+   return {"data": return_data}
+
+def service_stats():
+   prefix_cache_stats = {
+      'prefix_tokens': {language: len(prefix['input_ids']) for language, prefix in prefix_cache.items()},
+      **prefix_stats,
+   }
+   prompt_tokens = micro_batch_stats['prompt_tokens']
+   padded_prompt_tokens = micro_batch_stats['padded_prompt_tokens']
+   return {
+      "admission": admission.stats(),
+      "scheduler": scheduler.stats(),
+      "micro_batches": {
+         **micro_batch_stats,
+         'padding_efficiency': prompt_tokens / padded_prompt_tokens if padded_prompt_tokens else 1.0,
+      },
+      "prefix_cache": prefix_cache_stats,
+      "early_stop": early_stop_stats,
+      "inference_executor": inference_executor.stats(),
+      "startup_seconds": startup.timings,
+   }
+
+startup.install(app)
+
+@app.get("/stats", tags=["Monitoring"])
+async def stats():
+   return service_stats()
+
+install_request_metrics(app)
+
+admission.install(app, startup.ready.is_set)
+
+REGISTRY.register(StatsCollector(service_stats))
+REGISTRY.register(GPUCollector())
+
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
@@ -0,0 +1,38 @@
+# Functions that run in the image preprocessing process pool of the webservice
+# Worker processes only import this module, so it must not load the model
+from io import BytesIO
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+from PIL import Image
+from open_clip.transform import PreprocessCfg, image_transform_v2
+
+preprocess = None
+image_size = None
+shared_buffer = None
+slots = None
+
+# Builds the preprocessing of the model and attaches the shared memory slots that results are written to
+def init_worker(preprocess_cfg, shared_memory_name, slot_count, slot_shape):
+    global preprocess, image_size, shared_buffer, slots
+    # Every worker preprocesses one image at a time, parallelism comes from the number of workers
+    torch.set_num_threads(1)
+    preprocess = image_transform_v2(PreprocessCfg(**preprocess_cfg), is_train=False)
+    image_size = preprocess_cfg['size']
+    # The webservice owns the shared memory and unlinks it on shutdown, spawned workers share its resource tracker
+    shared_buffer = shared_memory.SharedMemory(name=shared_memory_name)
+    slots = np.ndarray((slot_count, *slot_shape), dtype=np.float32, buffer=shared_buffer.buf)
+
+# Decode an image, large JPEGs are decoded at 1/2, 1/4 or 1/8 scale directly from the DCT coefficients
+# as long as the result is still at least as large as the input size (height, width) of the model
+def open_image(image_bytes, size):
+    image = Image.open(BytesIO(image_bytes))
+    if image.format == 'JPEG':
+        image.draft('RGB', (size[1], size[0]))
+    return image
+
+# Decode and preprocess an image into a shared memory slot, only the slot number is sent back
+def preprocess_image(image_bytes, slot):
+    image = open_image(image_bytes, image_size)
+    slots[slot] = preprocess(image).numpy()
+    return slot
@@ -1,12 +1,53 @@
 import logging
 import sys
-from fastapi import FastAPI, Request
+import asyncio
+import time
+import json
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, Histogram, generate_latest
+from common.admission import AdmissionControl, current_ticket, check_ticket
+from common.metrics import TokenMeter, StatsCollector, GPUCollector, batch_sizes, install_request_metrics
+from common.executor import InferenceExecutor
+from common.startup import ModelStartup, download_model
+from common.replicas import ReplicaPool
+from common.cache import DiskCache
+from fastapi import Depends, FastAPI, Request, Response
+import httpx
 import torch
 import os
 os.environ['HF_HOME'] = '/llm_models'
 hf_access_token = os.getenv('HF_TOKEN')
 model_id = os.getenv('HUGGINGFACE_MODEL')
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+# Maximum number of rows that are generated together in one padded batch
+batch_size = int(os.getenv('BATCH_SIZE', '16'))
+# Maximum number of inference calls that are queued or running at the same time
+inference_queue_size = int(os.getenv('INFERENCE_QUEUE_SIZE', '64'))
+# Response cache for greedy requests: memory size, optional directory and size for the persistent tier
+response_cache_enabled = os.getenv('RESPONSE_CACHE', 'true').lower() == 'true'
+response_cache_mb = int(os.getenv('RESPONSE_CACHE_MB', '256'))
+response_cache_dir = os.getenv('RESPONSE_CACHE_DIR', '')
+response_cache_disk_mb = int(os.getenv('RESPONSE_CACHE_DISK_MB', '1024'))
+# Number of rows of the warmup batch that runs before the service reports ready, 0 disables the warmup
+warmup_rows = int(os.getenv('WARMUP_ROWS', '4'))
+# Optional draft model for assisted generation of greedy rows, e.g. a small model with the same tokenizer
+draft_model_id = os.getenv('DRAFT_MODEL', '')
+# Tokens the draft model proposes per step, 0 keeps the adaptive default of transformers
+num_assistant_tokens = int(os.getenv('NUM_ASSISTANT_TOKENS', '0'))
+# Number of model replicas in worker processes behind this webservice, e.g. one per GPU, 1 serves the model in this process
+replicas = int(os.getenv('REPLICAS', '1'))
+# Internal port of the first replica, the following replicas use the next ports
+replica_base_port = int(os.getenv('REPLICA_BASE_PORT', '9100'))
+# Admission control per endpoint: maximum number of requests that run at the same time and that wait for a slot,
+# further requests are rejected with status 429
+max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', '4'))
+max_queued_requests = int(os.getenv('MAX_QUEUED_REQUESTS', '16'))
+# Limits of single endpoints as concurrent:queued requests, e.g. /complete=2:8,/complete_custom=1:4
+endpoint_limits = os.getenv('ENDPOINT_LIMITS', '')
+# Deadline of a request in seconds, clients can send a shorter X-Request-Timeout header, 0 disables the deadline
+request_timeout = float(os.getenv('REQUEST_TIMEOUT', '600'))
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
 
 # Logging
 def get_logger(logger_name):
@@ -23,70 +64,418 @@ logger = get_logger('snowpark-container-service')
 
 app = FastAPI()
 
+# Metrics of this service, the metrics of all services are defined in common.metrics
+record_tokens = TokenMeter().record
+
+# Assisted generation per request: share of the draft tokens accepted by the target model and generated tokens per second
+assisted_acceptance_rate = Histogram('assisted_acceptance_rate', 'Share of draft tokens accepted per request', buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1))
+assisted_tokens_per_second = Histogram('assisted_tokens_per_second', 'Generated tokens per second per request with assisted generation', buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
 logger.info(f'cuda.is_available(): {torch.cuda.is_available()}')
 logger.info(f'cuda.device_count(): {torch.cuda.device_count()}')
 
 torch.random.manual_seed(0)
 
-# Loading model
-logger.info('Loading Model ...')
-model = AutoModelForCausalLM.from_pretrained(
-    model_id, 
-    device_map="auto", 
-    torch_dtype="auto", 
-    trust_remote_code=True, 
-    token=hf_access_token
-)
-tokenizer = AutoTokenizer.from_pretrained(model_id)
-pipe = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
+# Startup, see common.startup
+model = None
+tokenizer = None
+draft_model = None
+# Additional generate arguments for assisted generation, empty if no draft model is configured
+assistant_args = {}
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+startup = ModelStartup()
+
+def load_model():
+    global model, tokenizer
+    with startup.phase('download'):
+        model_path, use_safetensors = download_model(model_id, token=hf_access_token)
+    # safetensors files are memory mapped, weights are read directly from the volume
+    with startup.phase('weight_load'):
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype="auto",
+            trust_remote_code=True,
+            use_safetensors=use_safetensors,
+            low_cpu_mem_usage=True
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        # Batched generation requires left padding so that all prompts end at the same position
+        tokenizer.padding_side = 'left'
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+    with startup.phase('device_placement'):
+        model.to(device)
+        model.eval()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    if draft_model_id:
+        with startup.phase('draft_model'):
+            load_draft_model()
+
+def load_draft_model():
+    global draft_model, assistant_args
+    draft_path, use_safetensors = download_model(draft_model_id, token=hf_access_token)
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_path,
+        torch_dtype="auto",
+        trust_remote_code=True,
+        use_safetensors=use_safetensors,
+        low_cpu_mem_usage=True
+    )
+    draft_model.to(device)
+    draft_model.eval()
+    if num_assistant_tokens:
+        draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        draft_model.generation_config.num_assistant_tokens_schedule = 'constant'
+    args = {"assistant_model": draft_model}
+    if draft_model.config.get_text_config().vocab_size != model.config.get_text_config().vocab_size:
+        # Universal assisted decoding translates the draft tokens with both tokenizers, acceptance is counted in draft tokens
+        logger.info(f'Draft model {draft_model_id} has a different tokenizer, using universal assisted decoding')
+        args.update(tokenizer=tokenizer, assistant_tokenizer=AutoTokenizer.from_pretrained(draft_path))
+    # Every forward pass of the draft model proposes one token, every forward pass of the target model verifies the
+    # proposed tokens and adds one token of its own
+    model.register_forward_hook(lambda module, inputs, output: forward_passes.update(target=1))
+    draft_model.register_forward_hook(lambda module, inputs, output: forward_passes.update(draft=1))
+    assistant_args = args
+    logger.info(f'Assisted generation with draft model {draft_model_id} for greedy micro-batches of one row, '
+                'larger micro-batches are generated in batches without the draft model')
+
+# Run a representative batch through the generation path so that the first request doesn't pay for
+# CUDA kernel selection and allocator growth
+def warmup():
+    if warmup_rows <= 0:
+        return
+    prompt = render_prompt(default_system_prompt, 'Hello, who are you?')
+    generate_rows([(index, prompt, {"max_new_tokens": 8, "temperature": 0.0, "do_sample": False}) for index in range(warmup_rows)])
+
+# Download the model once, the replicas load it from the stage volume
+def start_replicas():
+    with startup.phase('download'):
+        download_model(model_id, token=hf_access_token)
+    with startup.phase('replicas'):
+        replica_pool.start()
+
+@app.on_event("startup")
+async def start_model_loading():
+    if replica_pool is not None:
+        replica_pool.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10), limits=httpx.Limits(max_connections=None))
+    startup.start(load_model, warmup, start_replicas if replica_pool is not None else None)
+
+# Stops a generate call as soon as its request is dropped, the truncated output is discarded by check_ticket
+class DroppedCriteria(StoppingCriteria):
+    def __init__(self):
+        self.ticket = current_ticket.get()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        dropped = self.ticket is not None and self.ticket.reason() is not None
+        return torch.full((input_ids.shape[0],), dropped, dtype=torch.bool, device=input_ids.device)
+
+admission = AdmissionControl(('/complete', '/complete_custom'), max_concurrent_requests, max_queued_requests, endpoint_limits, request_timeout)
+
+default_system_prompt = "You are a helpful digital assistant. Please provide safe, ethical and accurate information to the user."
+
+# Render the chat template for a single row
+def render_prompt(system_prompt, input_prompt):
+    messages = [
+        {"role": "system", "content": f"{system_prompt}"},
+        {"role": "user", "content": f"{input_prompt}"}
+    ]
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+# Generate responses for a list of rendered prompts with one padded generate call per micro-batch
+# Greedy micro-batches of a single row use assisted generation if a draft model is configured
+def generate_batch(prompts, generation_args):
+    assisted = bool(assistant_args) and not generation_args.get('do_sample')
+    responses = []
+    for start in range(0, len(prompts), batch_size):
+        micro_batch = prompts[start:start + batch_size]
+        if assisted and len(micro_batch) == 1:
+            responses.append(generate_assisted(micro_batch[0], generation_args))
+            continue
+        if assisted:
+            assisted_stats['batched_rows'] += len(micro_batch)
+        inputs = tokenizer(
+            micro_batch,
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False
+        ).to(model.device)
+        with torch.no_grad():
+            outputs = model.generate(**inputs, **generation_args, pad_token_id=tokenizer.pad_token_id, stopping_criteria=StoppingCriteriaList([DroppedCriteria()]))
+        check_ticket()
+        outputs = outputs[:, inputs['input_ids'].shape[1]:]
+        batch_sizes.observe(len(outputs))
+        record_tokens(inputs['attention_mask'].sum().item(), (outputs != tokenizer.pad_token_id).sum().item())
+        responses.extend(tokenizer.batch_decode(outputs, skip_special_tokens=True))
+    return responses
+
+forward_passes = Counter()
+assisted_stats = Counter()
+
+# Assisted generation supports only one row per generate call, the draft model proposes tokens and the target model
+# verifies all of them in a single forward pass
+def generate_assisted(prompt, generation_args):
+    inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(model.device)
+    started = time.perf_counter()
+    passes = forward_passes.copy()
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **generation_args, **assistant_args, pad_token_id=tokenizer.pad_token_id, stopping_criteria=StoppingCriteriaList([DroppedCriteria()]))
+    check_ticket()
+    outputs = outputs[0, inputs['input_ids'].shape[1]:]
+    assisted_stats.update(
+        rows=1,
+        generated_tokens=len(outputs),
+        generation_seconds=time.perf_counter() - started,
+        target_forward_passes=forward_passes['target'] - passes['target'],
+        draft_forward_passes=forward_passes['draft'] - passes['draft']
+    )
+    batch_sizes.observe(1)
+    record_tokens(inputs['input_ids'].shape[1], (outputs != tokenizer.pad_token_id).sum().item())
+    return tokenizer.decode(outputs, skip_special_tokens=True)
+
+# Acceptance rate and tokens per second of assisted generation from the difference of two snapshots of assisted_stats
+def assisted_summary(stats, before=Counter()):
+    stats = {name: stats[name] - before[name] for name in ('rows', 'batched_rows', 'generated_tokens', 'generation_seconds', 'target_forward_passes', 'draft_forward_passes')}
+    # Tokens that were not added by a forward pass of the target model were proposed by the draft model
+    stats['accepted_tokens'] = max(stats['generated_tokens'] - stats['target_forward_passes'], 0)
+    stats['acceptance_rate'] = min(stats['accepted_tokens'] / stats['draft_forward_passes'], 1.0) if stats['draft_forward_passes'] else 0.0
+    stats['tokens_per_second'] = stats['generated_tokens'] / stats['generation_seconds'] if stats['generation_seconds'] else 0.0
+    return stats
+
+# Generate responses for rows of (index, prompt, generation_args)
+# Rows with identical generation arguments are batched together, results keep the input order
+def generate_rows(rows):
+    before = assisted_stats.copy()
+    return_data = generate_row_groups(rows)
+    if assisted_stats['rows'] > before['rows']:
+        summary = assisted_summary(assisted_stats, before)
+        assisted_acceptance_rate.observe(summary['acceptance_rate'])
+        assisted_tokens_per_second.observe(summary['tokens_per_second'])
+        logger.info(
+            f"Assisted generation of {summary['rows']} rows: {summary['generated_tokens']} tokens, "
+            f"{summary['tokens_per_second']:.1f} tokens/s, acceptance rate {summary['acceptance_rate']:.1%}"
+        )
+    return return_data
+
+# Greedy generation ignores the sampling arguments, rows that only differ in them share a batch and a cache key
+def greedy_args(generation_args):
+    if generation_args.get('do_sample'):
+        return generation_args
+    return {name: value for name, value in generation_args.items() if name not in ('temperature', 'top_p', 'top_k')}
+
+def generate_row_groups(rows):
+    groups = {}
+    for position, (index, prompt, generation_args) in enumerate(rows):
+        key = tuple(sorted(greedy_args(generation_args).items()))
+        groups.setdefault(key, []).append((position, prompt))
+    return_data = [None] * len(rows)
+    for key, group in groups.items():
+        responses = generate_batch([prompt for _, prompt in group], dict(key))
+        for (position, _), response in zip(group, responses):
+            return_data[position] = [rows[position][0], response]
+    return return_data
+
+inference_executor = InferenceExecutor(inference_queue_size)
+
+# Every replica keeps its persistent response cache in its own directory
+def replica_env(number, threads):
+    return {'RESPONSE_CACHE_DIR': os.path.join(response_cache_dir, f'replica_{number}')} if response_cache_dir else {}
+
+replica_pool = ReplicaPool(replicas, replica_base_port, replica_env, os.path.dirname(os.path.abspath(__file__))) if replicas > 1 else None
+
+@app.on_event("shutdown")
+async def shutdown_replicas():
+    if replica_pool is not None:
+        replica_pool.shutdown()
+        await replica_pool.client.aclose()
+
+# Cache for responses of greedy requests, which are deterministic for the same prompt and generation arguments
+# Responses are kept in an in-memory LRU tier and an optional persistent tier on disk, both bounded by size
+class ResponseCache:
+    def __init__(self, namespace, max_bytes, disk_dir='', disk_max_bytes=0):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = DiskCache('Response cache', disk_dir, disk_max_bytes, '.txt') if disk_dir else None
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def key(self, prompt, generation_args):
+        content = json.dumps([self.namespace, prompt, greedy_args(generation_args)], sort_keys=True)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self.memory[key]
+        data = self.disk.read(key) if self.disk is not None else None
+        with self.lock:
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            response = data.decode('utf-8')
+            self.put_memory(key, response)
+            self.counters['disk_hits'] += 1
+            return response
+
+    def put(self, key, response):
+        with self.lock:
+            self.put_memory(key, response)
+        if self.disk is not None:
+            self.disk.write(key, response.encode('utf-8'))
+
+    def put_memory(self, key, response):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key).encode('utf-8'))
+        self.memory[key] = response
+        self.memory_bytes += len(response.encode('utf-8'))
+        while self.memory_bytes > self.max_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted.encode('utf-8'))
+
+    def put_many(self, items):
+        for key, response in items:
+            self.put(key, response)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        disk_entries, disk_bytes = self.disk.size() if self.disk is not None else (0, 0)
+        with self.lock:
+            lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+            hits = self.counters['memory_hits'] + self.counters['disk_hits']
+            return {
+                **self.counters,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_entries': disk_entries,
+                'disk_bytes': disk_bytes,
+            }
+
+response_cache = ResponseCache(
+    namespace=model_id,
+    max_bytes=response_cache_mb * 2**20,
+    # With replicas, every replica keeps its own persistent tier
+    disk_dir=response_cache_dir if replicas <= 1 else '',
+    disk_max_bytes=response_cache_disk_mb * 2**20
 )
-logger.info('Finished Loading Model.')
 
-   
-@app.post("/complete", tags=["Endpoints"])
+# Look up cached responses of greedy rows
+# Returns the cached responses, the cache key of each row and the positions of the rows that have to be generated,
+# rows that share a cache key with an earlier row of the batch are generated only once
+def lookup_rows(rows):
+    return_data = [None] * len(rows)
+    keys = [None] * len(rows)
+    to_generate = []
+    first_positions = {}
+    for position, (index, prompt, generation_args) in enumerate(rows):
+        if not response_cache_enabled or generation_args.get('do_sample'):
+            response_cache.count('bypassed')
+            to_generate.append(position)
+            continue
+        key = keys[position] = response_cache.key(prompt, generation_args)
+        if key in first_positions:
+            response_cache.count('deduplicated')
+            continue
+        first_positions[key] = position
+        response = response_cache.get(key)
+        if response is not None:
+            return_data[position] = [index, response]
+        else:
+            to_generate.append(position)
+    return return_data, keys, to_generate
+
+# Answer rows of (index, prompt, generation_args) from the response cache and generate the remaining rows
+async def complete_rows(rows):
+    loop = asyncio.get_running_loop()
+    return_data, keys, to_generate = await loop.run_in_executor(None, lookup_rows, rows)
+    if to_generate:
+        generated = await inference_executor.run(generate_rows, [rows[position] for position in to_generate])
+        for position, (_, response) in zip(to_generate, generated):
+            return_data[position] = [rows[position][0], response]
+        await loop.run_in_executor(None, response_cache.put_many, [(keys[position], return_data[position][1]) for position in to_generate if keys[position] is not None])
+    # Rows that share their cache key with an earlier row of the batch
+    first_positions = {}
+    for position, key in enumerate(keys):
+        if return_data[position] is None:
+            return_data[position] = [rows[position][0], return_data[first_positions[key]][1]]
+        elif key is not None:
+            first_positions.setdefault(key, position)
+    return return_data
+
+@app.post("/complete", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
 async def complete(request: Request):
     # input_prompt
     request_body = await request.json()
     request_body = request_body['data']
-    return_data = []
+    request.state.rows = len(request_body)
+    if replica_pool is not None:
+        return {"data": await replica_pool.complete_rows(request, request_body)}
+    generation_args = {
+        "max_new_tokens": 500,
+        "temperature": 0.0,
+        "do_sample": False,
+    }
+    rows = []
     for index, input_prompt  in request_body:
-        generation_args = {
-            "max_new_tokens": 500,
-            "return_full_text": False,
-            "temperature": 0.0,
-            "do_sample": False,
-        }
-        messages = [
-            {"role": "system", "content": "You are a helpful digital assistant. Please provide safe, ethical and accurate information to the user."},
-            {"role": "user", "content": f"{input_prompt}"}
-        ]
-        output = pipe(messages, **generation_args)
-        response = output[0]['generated_text']
-        return_data.append([index, response])
+        rows.append((index, render_prompt(default_system_prompt, input_prompt), generation_args))
+    return_data = await complete_rows(rows)
     return {"data": return_data}
 
 
-@app.post("/complete_custom", tags=["Endpoints"])
+@app.post("/complete_custom", tags=["Endpoints"], dependencies=[Depends(startup.check_ready)])
 async def complete_custom(request: Request):
     # system_prompt, input_prompt, max_new_tokens, temperature
     request_body = await request.json()
     request_body = request_body['data']
-    return_data = []
+    request.state.rows = len(request_body)
+    if replica_pool is not None:
+        return {"data": await replica_pool.complete_rows(request, request_body)}
+    rows = []
     for index, system_prompt, input_prompt, max_new_tokens, temperature  in request_body:
         generation_args = {
             "max_new_tokens": max_new_tokens,
-            "return_full_text": False,
             "temperature": temperature,
             "do_sample": False,
         }
-        messages = [
-            {"role": "system", "content": f"{system_prompt}"},
-            {"role": "user", "content": f"{input_prompt}"}
-        ]
-        output = pipe(messages, **generation_args)
-        response = output[0]['generated_text']
-        return_data.append([index, response])
-    return {"data": return_data}
\ No newline at end of file
+        rows.append((index, render_prompt(system_prompt, input_prompt), generation_args))
+    return_data = await complete_rows(rows)
+    return {"data": return_data}
+
+
+def service_stats():
+    if replica_pool is not None:
+        return {"replicas": replica_pool.stats(), "admission": admission.stats(), "startup_seconds": startup.timings}
+    return {
+        "admission": admission.stats(),
+        "inference_executor": inference_executor.stats(),
+        "response_cache": response_cache.stats(),
+        "assisted_generation": {"draft_model": draft_model_id, **assisted_summary(assisted_stats)} if draft_model_id else {},
+        "startup_seconds": startup.timings
+    }
+
+startup.install(app, replica_pool.error if replica_pool is not None else None)
+
+# With replicas, the stats of every replica are included as well
+@app.get("/stats", tags=["Monitoring"])
+async def stats():
+    if replica_pool is not None and startup.ready.is_set():
+        return {**service_stats(), "replica_stats": await replica_pool.replica_stats()}
+    return service_stats()
+
+install_request_metrics(app)
+
+admission.install(app, startup.ready.is_set)
+
+REGISTRY.register(StatsCollector(service_stats))
+REGISTRY.register(GPUCollector())
+
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file